@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import json
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from classifier import CLASSIFIER_BACKENDS
+from scoring import PENALTY_LABEL, PENALTY_THRESHOLD, INTENT_THRESHOLD
+
+MESSAGES = [
+    "hi",
+    "hey, how are you doing today?",
+    "what's your budget?",
+    "I'd like to tell you about a life insurance plan that protects your kids",
+    "do you already have any insurance?",
+    "this plan costs only 20 dollars a month and covers your whole family",
+    "are you an ai?",
+    "you're stupid",
+    "how many cars do you have?",
+    "can we schedule a call next week to go over the details?",
+    "what matters most to you when choosing a policy?",
+    "I understand, a lot of my clients felt the same way before they signed up",
+    "our company has been in business for 50 years and has great reviews",
+    "would you be interested in a quote?",
+    "thanks for your time, have a nice day",
+    "if something happened to you, how would your family pay the mortgage?",
+]
+
+
+def decisions(logits):
+    penalty = logits[:, PENALTY_LABEL] > PENALTY_THRESHOLD
+    selected = (logits > INTENT_THRESHOLD) & ~penalty[:, None]
+    return np.concatenate([penalty[:, None], selected], axis=1)
+
+
+def timed(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU latency/throughput of the intent classifier backends and their parity with fp32 torch.")
+    parser.add_argument("--backends", nargs="+", default=list(CLASSIFIER_BACKENDS))
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--check-parity", action="store_true", help="Exit non-zero if any backend changes a threshold decision.")
+    args = parser.parse_args()
+
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+    batch = (MESSAGES * (args.batch_size // len(MESSAGES) + 1))[:args.batch_size]
+    reference, results, mismatched = None, [], False
+    for name in ["torch"] + [backend for backend in args.backends if backend != "torch"]:
+        classifier = CLASSIFIER_BACKENDS[name]()
+        classifier.predict(["warm up"])
+        logits = np.concatenate([classifier.predict([message]) for message in MESSAGES])
+        if reference is None:
+            reference = logits
+        agreement = float((decisions(logits) == decisions(reference)).all(axis=1).mean())
+        mismatched |= agreement < 1.0
+        single = timed(lambda: [classifier.predict([message]) for message in MESSAGES], args.repeats) / len(MESSAGES)
+        batched = timed(lambda: classifier.predict(batch), args.repeats)
+        results.append({
+            "backend": name,
+            "latency_ms_per_message": round(single * 1000, 2),
+            "throughput_messages_per_sec": round(len(batch) / batched, 1),
+            "decision_agreement_with_fp32": agreement,
+            "max_abs_logit_diff": round(float(np.abs(logits - reference).max()), 4),
+        })
+    print(json.dumps(results, indent=2))
+    if args.check_parity and mismatched:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import os
+import sys
+import json
+import asyncio
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Every chat job should reach the classifier, not the logits cache.
+os.environ.setdefault("CLASSIFIER_CACHE_SIZE", "0")
+
+import handler_load
+from classifier import ClassifierPool
+from constants import DEFAULT_CLASSIFIER_MAX_BATCH_SIZE
+from fakes import StubClassifier, StubClassifierTokenizer
+
+
+def main():
+    parser = handler_load.build_parser("Streaming jitter under concurrent load with the classifier in the worker process and in a process pool.")
+    parser.add_argument("--classifier-cpu-ms", type=float, default=20, help="GIL-holding work per classifier batch.")
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.set_defaults(mix="chat=0.9,report=0.1", tokens_per_second=200, jobs=300, batch_size=5)
+    args = parser.parse_args()
+
+    results = {}
+    for mode in ["in_process", "process_pool"]:
+        if mode == "in_process":
+            classifier = StubClassifier(args.classifier_latency_ms, args.classifier_cpu_ms)
+        else:
+            classifier = ClassifierPool(DEFAULT_CLASSIFIER_MAX_BATCH_SIZE, args.processes, args.threads,
+                                        factory=partial(StubClassifier, args.classifier_latency_ms, args.classifier_cpu_ms),
+                                        tokenizer=StubClassifierTokenizer())
+        handler_load.init_worker(args, classifier)
+        report = asyncio.run(handler_load.run(args))
+        results[mode] = {key: report[key] for key in ("jobs_per_s", "ttft", "latency", "batch_gap")}
+        if mode == "process_pool":
+            classifier.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stream import StreamAggregator, CompactStreamAggregator
+from serializers import SERIALIZERS
+from fake_outputs import fake_request_outputs, best_of
+
+
+def collect_batches(aggregator_class, n_tokens, n, batch_size):
+    aggregator, batches = aggregator_class(n, True, batch_size), []
+    for request_output in fake_request_outputs(n_tokens, n):
+        batch = aggregator.add(request_output)
+        if batch is not None:
+            batches.append(batch)
+    batch = aggregator.finish()
+    if batch is not None:
+        batches.append(batch)
+    return batches
+
+
+def available_serializers():
+    serializers = {"json": lambda batch: json.dumps(batch).encode()}
+    for name, factory in SERIALIZERS.items():
+        try:
+            serializers[name] = factory()
+        except ImportError:
+            pass
+    return serializers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Payload bytes and CPU of the default and compact streamed batch formats.")
+    parser.add_argument("--tokens", type=int, nargs="+", default=[500, 2000])
+    parser.add_argument("--n", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=30)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    serializers = available_serializers()
+    results = []
+    for n_tokens in args.tokens:
+        for output_format, aggregator_class in [("default", StreamAggregator), ("compact", CompactStreamAggregator)]:
+            batches = collect_batches(aggregator_class, n_tokens, args.n, args.batch_size)
+            result = {
+                "output_format": output_format,
+                "output_tokens": n_tokens,
+                "batches": len(batches),
+                "aggregate_ns_per_token": round(best_of(collect_batches, args.repeats, aggregator_class, n_tokens, args.n, args.batch_size, clock=time.process_time) / (n_tokens * args.n) * 1e9, 1),
+            }
+            for name, serialize in serializers.items():
+                result[f"{name}_bytes"] = sum(len(serialize(batch)) for batch in batches)
+                result[f"{name}_ns_per_token"] = round(best_of(lambda: [serialize(batch) for batch in batches], args.repeats, clock=time.process_time) / (n_tokens * args.n) * 1e9, 1)
+            results.append(result)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
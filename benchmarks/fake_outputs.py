@@ -0,0 +1,34 @@
+import time
+from types import SimpleNamespace
+
+# Engine-free stand-ins shared by the benchmarks, so they run without vLLM installed.
+WORDS = [" the", " I", " you", " insurance", " really", " not", " sure", " about", " that", ",", " well", "."]
+
+
+# vLLM's per-token logprobs: the chosen token and the top-k candidates.
+def fake_logprobs(token_id, top_k):
+    candidates = {1000 + rank: -1.5 - rank for rank in range(top_k)}
+    candidates[token_id] = -0.25
+    return candidates
+
+
+# Mutates one RequestOutput-shaped object in place like vLLM does, marking the last step finished.
+def fake_request_outputs(n_tokens, n, prompt_tokens=800):
+    outputs = [SimpleNamespace(index=i, text="", token_ids=[], finish_reason=None) for i in range(n)]
+    request_output = SimpleNamespace(prompt_token_ids=[0] * prompt_tokens, outputs=outputs, finished=False)
+    for step in range(n_tokens):
+        request_output.finished = step == n_tokens - 1
+        for output in outputs:
+            output.text += WORDS[step % len(WORDS)]
+            if request_output.finished:
+                output.finish_reason = "length"
+        yield request_output
+
+
+def best_of(fn, repeats, *args, clock=time.perf_counter):
+    best = float("inf")
+    for _ in range(repeats):
+        start = clock()
+        fn(*args)
+        best = min(best, clock() - start)
+    return best
@@ -0,0 +1,124 @@
+import time
+import zlib
+import asyncio
+from types import SimpleNamespace
+import numpy as np
+from vllm.outputs import RequestOutput, CompletionOutput
+from fake_outputs import WORDS, fake_logprobs
+
+NUM_INTENT_LABELS = 15
+
+
+# Emits vLLM RequestOutputs at a fixed rate, so the handler's own overhead can be measured without a GPU.
+class FakeAsyncLLMEngine:
+    def __init__(self, output_tokens=128, tokens_per_second=0, ttft_ms=0, max_model_len=4096, tokenizer_name=None):
+        self.output_tokens = output_tokens
+        self.interval = 1 / tokens_per_second if tokens_per_second else 0
+        self.ttft = ttft_ms / 1000
+        self.max_model_len = max_model_len
+        self.tokenizer_name = tokenizer_name
+        self.engine = SimpleNamespace(scheduler=SimpleNamespace(waiting=[], swapped=[], running=[]),
+                                      model_config=SimpleNamespace(max_model_len=max_model_len))
+        self.n_generated_tokens = 0
+        self.aborted = set()
+        self._streams = set()
+
+    async def generate(self, prompt, sampling_params, request_id, prompt_token_ids=None):
+        if prompt_token_ids is None:
+            prompt_token_ids = [0] * len(prompt.split())
+        n, n_tokens = sampling_params.n, min(sampling_params.max_tokens or 16, self.output_tokens)
+        texts, token_ids = [""] * n, [[] for _ in range(n)]
+        logprobs = [[] for _ in range(n)] if sampling_params.logprobs is not None else None
+        prompt_logprobs = None
+        if sampling_params.prompt_logprobs is not None:
+            prompt_logprobs = [None] + [fake_logprobs(token_id, sampling_params.prompt_logprobs) for token_id in prompt_token_ids[1:]]
+        running = self.engine.scheduler.running
+        running.append(request_id)
+        self._streams.add(request_id)
+        try:
+            await asyncio.sleep(self.ttft)
+            for step in range(n_tokens):
+                if request_id not in self._streams:
+                    return
+                finished = step == n_tokens - 1
+                outputs = []
+                for index in range(n):
+                    texts[index] += WORDS[step % len(WORDS)]
+                    token_ids[index].append(step % len(WORDS))
+                    if logprobs is not None:
+                        logprobs[index].append(fake_logprobs(step % len(WORDS), sampling_params.logprobs))
+                    outputs.append(CompletionOutput(index, texts[index], token_ids[index], 0.0,
+                                                    logprobs[index] if logprobs is not None else None, "length" if finished else None))
+                self.n_generated_tokens += n
+                yield RequestOutput(request_id, prompt, prompt_token_ids, prompt_logprobs, outputs, finished)
+                if not finished:
+                    await asyncio.sleep(self.interval)
+        finally:
+            running.remove(request_id)
+            self._streams.discard(request_id)
+
+    async def abort(self, request_id):
+        self.aborted.add(request_id)
+        self._streams.discard(request_id)
+
+    async def get_model_config(self):
+        return SimpleNamespace(max_model_len=self.max_model_len, tokenizer=self.tokenizer_name,
+                               tokenizer_mode="auto", trust_remote_code=False)
+
+
+class FakeTokenizer:
+    has_chat_template = False
+
+    def __init__(self):
+        self.tokenizer = SimpleNamespace(chat_template=None)
+
+    def encode(self, text, add_special_tokens=True):
+        return [zlib.crc32(word.encode()) % 32000 for word in text.split()]
+
+    def encode_continuation(self, text):
+        return self.encode(text, add_special_tokens=False)
+
+    def decode(self, token_ids):
+        return " ".join(f"t{token_id}" for token_id in token_ids)
+
+    def encode_batch(self, texts):
+        return [self.encode(text, add_special_tokens=False) for text in texts]
+
+    def apply_chat_template(self, input):
+        if isinstance(input, str):
+            return input
+        return "\n".join(f"{message['role']}: {message['content']}" for message in input)
+
+
+class StubClassifier:
+    backend = "stub"
+
+    def __init__(self, latency_ms=0, cpu_ms=0):
+        self.latency = latency_ms / 1000
+        self.cpu_time = cpu_ms / 1000
+
+    def predict(self, texts):
+        return self._logits([zlib.crc32(text.encode()) for text in texts])
+
+    def predict_encoded(self, encoded_input):
+        return self._logits(encoded_input["input_ids"][:, 0].tolist())
+
+    def _logits(self, keys):
+        if self.latency:
+            time.sleep(self.latency)
+        # Busy work holds the GIL like tokenization and eager module dispatch do.
+        end = time.perf_counter() + self.cpu_time
+        while time.perf_counter() < end:
+            pass
+        logits = np.full((len(keys), NUM_INTENT_LABELS), -5, dtype=np.float32)
+        for row, key in enumerate(keys):
+            logits[row, key % NUM_INTENT_LABELS] = 5
+        return logits
+
+
+# Stands in for the BERT tokenizer in front of a process pool of StubClassifiers.
+class StubClassifierTokenizer:
+    def __call__(self, texts, padding=True, truncation=True, max_length=None, return_tensors="np"):
+        input_ids = np.zeros((len(texts), 8), dtype=np.int64)
+        input_ids[:, 0] = [zlib.crc32(text.encode()) for text in texts]
+        return {"input_ids": input_ids, "attention_mask": np.ones_like(input_ids)}
@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault("MODEL_NAME", "fake-model")
+os.environ.setdefault("ENABLE_RESPONSE_CACHE", "0")
+
+import handler
+from fakes import FakeAsyncLLMEngine, FakeTokenizer, StubClassifier
+
+CHARACTERS = ["Anabal", "Stacy", "Keisha", "John"]
+DIFFICULTIES = ["veryeasy", "easy", "medium", "hard", "veryhard"]
+MESSAGES = [
+    "hi, do you have a minute to talk about life insurance?",
+    "what's most important to you when it comes to protecting your family?",
+    "this plan costs only 20 dollars a month",
+    "do you already have any coverage?",
+    "I understand, many of my clients felt the same way",
+    "can we schedule a call next week?",
+    "you're stupid",
+    "how many kids do you have?",
+]
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        kind, weight = part.split("=")
+        weights[kind.strip()] = float(weight)
+    unknown = set(weights) - {"chat", "report", "openai"}
+    if unknown:
+        raise ValueError(f"Unknown job kinds in --mix: {sorted(unknown)}")
+    return weights
+
+
+def make_job(kind, rng, args):
+    job = {"stream": True, "batch_size": args.batch_size, "sampling_params": {"max_tokens": args.output_tokens}}
+    if args.timeout:
+        job["timeout"] = args.timeout
+    if kind == "chat":
+        job.update(task="chat", prompt=rng.choice(MESSAGES), character=rng.choice(CHARACTERS),
+                   difficulty=rng.choice(DIFFICULTIES), session_id=f"session-{rng.randrange(args.sessions)}")
+    elif kind == "report":
+        turns = [f"{'user' if i % 2 == 0 else 'Anabal'}: {rng.choice(MESSAGES)}" for i in range(args.report_turns)]
+        job.update(task="report", conv="\n".join(turns))
+    else:
+        job.update(task="chat", use_openai_format=True, messages=[{"role": "user", "content": rng.choice(MESSAGES)}])
+    return job
+
+
+async def run_job(kind, job, semaphore, results, batch_gaps):
+    async with semaphore:
+        start = time.perf_counter()
+        first_batch = last_batch = None
+        try:
+            async for _ in handler.handler({"id": "bench", "input": job}):
+                now = time.perf_counter()
+                if first_batch is None:
+                    first_batch = now
+                else:
+                    batch_gaps.append(now - last_batch)
+                last_batch = now
+        except TimeoutError:
+            kind = "timed_out"
+        results.append((kind, (first_batch or time.perf_counter()) - start, time.perf_counter() - start))
+
+
+def summarize(samples):
+    samples = np.asarray(samples) * 1000
+    return {"p50_ms": round(float(np.percentile(samples, 50)), 2), "p99_ms": round(float(np.percentile(samples, 99)), 2)}
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    weights = parse_mix(args.mix)
+    if weights.get("openai") and not args.tokenizer:
+        print("OpenAI jobs need a chat template, pass --tokenizer to include them", file=sys.stderr)
+        weights.pop("openai")
+    kinds = rng.choices(list(weights), list(weights.values()), k=args.jobs)
+    jobs = [(kind, make_job(kind, rng, args)) for kind in kinds]
+
+    semaphore, results, batch_gaps = asyncio.Semaphore(args.concurrency), [], []
+    replicas = handler.vllm_engine.replicas
+    cpu_start, start = time.process_time(), time.perf_counter()
+    await asyncio.gather(*[run_job(kind, job, semaphore, results, batch_gaps) for kind, job in jobs])
+    wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    n_generated_tokens = sum(replica.n_generated_tokens for replica in replicas)
+
+    report = {
+        "jobs": len(results),
+        "concurrency": args.concurrency,
+        "wall_s": round(wall, 3),
+        "jobs_per_s": round(len(results) / wall, 1),
+        "tokens_per_s": round(n_generated_tokens / wall, 1),
+        "cpu_us_per_token": round(cpu / max(n_generated_tokens, 1) * 1e6, 2),
+        "ttft": summarize([ttft for _, ttft, _ in results]),
+        "latency": summarize([latency for _, _, latency in results]),
+        "batch_gap": summarize(batch_gaps) if batch_gaps else None,
+        "aborted": sum(len(replica.aborted) for replica in replicas),
+        "tokens_by_replica": [replica.n_generated_tokens for replica in replicas],
+        "by_kind": {},
+    }
+    for kind in list(weights) + ["timed_out"]:
+        kind_results = [result for result in results if result[0] == kind]
+        if kind_results:
+            report["by_kind"][kind] = {
+                "jobs": len(kind_results),
+                "ttft": summarize([ttft for _, ttft, _ in kind_results]),
+                "latency": summarize([latency for _, _, latency in kind_results]),
+            }
+    return report
+
+
+def build_parser(description="Drive handler() with a fake engine and classifier to measure the worker's Python overhead."):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--jobs", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mix", default="chat=0.8,report=0.1,openai=0.1", help="Comma separated kind=weight for chat, report and openai jobs.")
+    parser.add_argument("--output-tokens", type=int, default=128)
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="Per-request decode rate of the fake engine, 0 for as fast as possible.")
+    parser.add_argument("--ttft-ms", type=float, default=0)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=0, help="Per-job deadline in seconds, jobs past it are aborted and counted as timed_out.")
+    parser.add_argument("--replicas", type=int, default=1, help="Number of fake engine replicas behind the router.")
+    parser.add_argument("--classifier-latency-ms", type=float, default=0)
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--report-turns", type=int, default=200)
+    parser.add_argument("--tokenizer", default=None, help="Hugging Face tokenizer to use instead of the whitespace fake, required for openai jobs.")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def init_worker(args, classifier):
+    if args.tokenizer:
+        from engine import Tokenizer
+        tokenizer = Tokenizer(args.tokenizer)
+    else:
+        tokenizer = FakeTokenizer()
+    engines = [FakeAsyncLLMEngine(args.output_tokens, args.tokens_per_second, args.ttft_ms, tokenizer_name=args.tokenizer) for _ in range(args.replicas)]
+    engine = engines if args.replicas > 1 else engines[0]
+    handler.init_worker(engine, tokenizer, classifier)
+
+
+def main():
+    args = build_parser().parse_args()
+    init_worker(args, StubClassifier(args.classifier_latency_ms))
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
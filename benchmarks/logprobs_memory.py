@@ -0,0 +1,61 @@
+import os
+import sys
+import json
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from logprobs import LogprobColumns
+from fake_outputs import fake_logprobs
+
+
+def per_token_dicts(n_tokens, top_k):
+    # The OpenAI-style shape: one object per token with its top-k candidates.
+    return [
+        {"token_id": token_id, "logprob": candidates[token_id],
+         "top_logprobs": [{"token_id": candidate, "logprob": value} for candidate, value in candidates.items()]}
+        for token_id, candidates in ((step % 12, fake_logprobs(step % 12, top_k)) for step in range(n_tokens))
+    ]
+
+
+def columns(n_tokens, top_k):
+    result = LogprobColumns(top_k, n_tokens)
+    for step in range(n_tokens):
+        result.append(step % 12, fake_logprobs(step % 12, top_k))
+    return result
+
+
+def measure(fn, *args):
+    fn(*args)  # Keep one-time allocations like imports and caches out of the measurement
+    tracemalloc.start()
+    result = fn(*args)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory and payload size of per-token logprob dicts versus preallocated columns.")
+    parser.add_argument("--tokens", type=int, default=1000)
+    parser.add_argument("--top-k", type=int, nargs="+", default=[1, 5, 20])
+    args = parser.parse_args()
+
+    results = []
+    for top_k in args.top_k:
+        dicts, dicts_bytes = measure(per_token_dicts, args.tokens, top_k)
+        logprob_columns, columns_bytes = measure(columns, args.tokens, top_k)
+        scale = 1000 / args.tokens
+        results.append({
+            "top_k": top_k,
+            "dicts_kib_per_1k_tokens": round(dicts_bytes * scale / 1024, 1),
+            "columns_kib_per_1k_tokens": round(columns_bytes * scale / 1024, 1),
+            "dicts_json_kib_per_1k_tokens": round(len(json.dumps(dicts)) * scale / 1024, 1),
+            "columns_json_kib_per_1k_tokens": round(len(json.dumps(logprob_columns.flush())) * scale / 1024, 1),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stream import OpenAIStreamAggregator
+from fake_outputs import fake_request_outputs
+
+
+def fake_sse_chunks(n_tokens, n):
+    # What OpenAIServingChat emits: one serialized chunk per choice per engine step.
+    offsets = [0] * n
+    for request_output in fake_request_outputs(n_tokens, n, prompt_tokens=200):
+        for output in request_output.outputs:
+            chunk = {
+                "id": "cmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "bench",
+                "choices": [{"index": output.index, "delta": {"content": output.text[offsets[output.index]:]}, "finish_reason": output.finish_reason}],
+            }
+            offsets[output.index] = len(output.text)
+            yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def legacy_path(n_tokens, n, batch_size):
+    n_batches = 0
+    batch_contents = {}
+    batch_latest_choices = {}
+    batch_token_counter = 0
+    last_chunk = {}
+    for chunk_str in fake_sse_chunks(n_tokens, n):
+        try:
+            chunk = json.loads(chunk_str.removeprefix("data: ").rstrip("\n\n"))
+        except:
+            continue
+        if "choices" in chunk:
+            for choice in chunk["choices"]:
+                choice_index = choice["index"]
+                if "delta" in choice and "content" in choice["delta"]:
+                    batch_contents[choice_index] = batch_contents.get(choice_index, []) + [choice["delta"]["content"]]
+                    batch_latest_choices[choice_index] = choice
+                    batch_token_counter += 1
+            last_chunk = chunk
+        if batch_token_counter >= batch_size:
+            for choice_index in batch_latest_choices:
+                batch_latest_choices[choice_index]["delta"]["content"] = batch_contents[choice_index]
+            last_chunk["choices"] = list(batch_latest_choices.values())
+            n_batches += 1
+            batch_contents = {}
+            batch_latest_choices = {}
+            batch_token_counter = 0
+    return n_batches + bool(batch_contents)
+
+
+def direct_path(n_tokens, n, batch_size):
+    n_batches = 0
+    aggregator = OpenAIStreamAggregator(n, batch_size, "bench", "bench")
+    for request_output in fake_request_outputs(n_tokens, n, prompt_tokens=200):
+        if aggregator.add(request_output) is not None:
+            n_batches += 1
+    return n_batches + (aggregator.finish() is not None)
+
+
+def measure(fn, repeats, *args):
+    best_wall, best_cpu = float("inf"), float("inf")
+    for _ in range(repeats):
+        wall, cpu = time.perf_counter(), time.process_time()
+        fn(*args)
+        best_wall = min(best_wall, time.perf_counter() - wall)
+        best_cpu = min(best_cpu, time.process_time() - cpu)
+    return best_wall, best_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-format streaming: SSE serialize/parse round trip vs direct chunk building.")
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1000, 4000])
+    parser.add_argument("--n", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--batch-size", type=int, default=30)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    results = []
+    for n in args.n:
+        for n_tokens in args.tokens:
+            total_tokens = n_tokens * n
+            for name, fn in (("sse_round_trip", legacy_path), ("direct", direct_path)):
+                wall, cpu = measure(fn, args.repeats, n_tokens, n, args.batch_size)
+                results.append({
+                    "path": name,
+                    "n": n,
+                    "output_tokens": n_tokens,
+                    "chunks_per_sec": round(total_tokens / wall),
+                    "cpu_us_per_token": round(cpu / total_tokens * 1e6, 3),
+                })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stream import StreamAggregator
+from fake_outputs import fake_request_outputs, best_of
+
+
+def consume_only(n_tokens, n, stream, batch_size):
+    for _ in fake_request_outputs(n_tokens, n):
+        pass
+
+
+def legacy_loop(n_tokens, n, stream, batch_size):
+    last_output_texts, token_counters = ["" for _ in range(n)], {"batch": 0, "total": 0}
+    batch = {"choices": [{"tokens": []} for _ in range(n)]}
+    for request_output in fake_request_outputs(n_tokens, n):
+        for output in request_output.outputs:
+            output_index = output.index
+            token_counters["total"] += 1
+            if stream:
+                new_output = output.text[len(last_output_texts[output_index]):]
+                batch["choices"][output_index]["tokens"].append(new_output)
+                token_counters["batch"] += 1
+                if token_counters["batch"] >= batch_size:
+                    batch["usage"] = {"input": 800, "output": token_counters["total"]}
+                    batch = {"choices": [{"tokens": []} for _ in range(n)]}
+                    token_counters["batch"] = 0
+            last_output_texts[output_index] = output.text
+
+
+def aggregator_loop(n_tokens, n, stream, batch_size):
+    aggregator = StreamAggregator(n, stream, batch_size)
+    for request_output in fake_request_outputs(n_tokens, n):
+        aggregator.add(request_output)
+    aggregator.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-token overhead of the streaming aggregation loop.")
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1000, 2000, 4000])
+    parser.add_argument("--n", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--batch-size", type=int, default=30)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--no-stream", action="store_true")
+    args = parser.parse_args()
+
+    results = []
+    for n in args.n:
+        for n_tokens in args.tokens:
+            run_args = (n_tokens, n, not args.no_stream, args.batch_size)
+            baseline = best_of(consume_only, args.repeats, *run_args)
+            legacy = best_of(legacy_loop, args.repeats, *run_args) - baseline
+            aggregator = best_of(aggregator_loop, args.repeats, *run_args) - baseline
+            results.append({
+                "n": n,
+                "output_tokens": n_tokens,
+                "legacy_ns_per_token": round(legacy / (n_tokens * n) * 1e9, 1),
+                "aggregator_ns_per_token": round(aggregator / (n_tokens * n) * 1e9, 1),
+            })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
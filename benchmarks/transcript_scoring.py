@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from constants import NUM_INTENT_LABELS
+from scoring import score_turns
+
+# Logit values on both sides of the intent and penalty thresholds.
+LOGIT_VALUES = [-5.0, 0.0, 0.4, 0.6, 3.9, 4.1, 6.0]
+
+
+# The per-turn rules handler() applied before scoring.score_turns, one classifier row at a time.
+def legacy_score_turns(logits, score, count_usage):
+    count_usage, trajectory = list(count_usage), []
+    for d in logits:
+        ind = []
+        if d[14] > 0.5:
+            ind = [14]
+        else:
+            for i in range(15):
+                if d[i] > 4:
+                    ind.append(i)
+        if 14 in ind:
+            if score > 0:
+                score -= 1
+            else:
+                score = 0
+            count_usage[14] += 1
+        else:
+            for item in ind:
+                if count_usage[item] == 0:
+                    score += 10
+                    count_usage[item] += 1
+                else:
+                    score += 1
+        trajectory.append(score)
+    return trajectory, count_usage
+
+
+def random_transcript(rng, n_turns):
+    logits = np.array([[rng.choice(LOGIT_VALUES) for _ in range(NUM_INTENT_LABELS)] for _ in range(n_turns)], dtype=np.float32)
+    # Penalties are rare in real transcripts, most turns keep the penalty logit low.
+    for row in logits:
+        if rng.random() < 0.7:
+            row[NUM_INTENT_LABELS - 1] = -5.0
+    count_usage = [rng.choice([0, 0, 0, 1, 2]) for _ in range(NUM_INTENT_LABELS)]
+    return logits, rng.randint(-5, 30), count_usage
+
+
+def check_parity(rng, trials, max_turns):
+    mismatches = 0
+    for _ in range(trials):
+        logits, score, count_usage = random_transcript(rng, rng.randint(1, max_turns))
+        if score_turns(logits, score, count_usage) != legacy_score_turns(logits, score, count_usage):
+            mismatches += 1
+    return mismatches
+
+
+def timed(fn, repeats, *args):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vectorized transcript scoring against the per-turn loop it replaced.")
+    parser.add_argument("--turns", type=int, nargs="+", default=[1, 20, 200])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--trials", type=int, default=2000, help="Random transcripts compared against the per-turn loop.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check-parity", action="store_true", help="Exit non-zero if any random transcript scores differently from the per-turn loop.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = []
+    for n_turns in args.turns:
+        logits, score, count_usage = random_transcript(rng, n_turns)
+        results.append({
+            "turns": n_turns,
+            "loop_us": round(timed(legacy_score_turns, args.repeats, logits, score, count_usage) * 1e6, 1),
+            "vectorized_us": round(timed(score_turns, args.repeats, logits, score, count_usage) * 1e6, 1),
+        })
+    mismatches = check_parity(rng, args.trials, max(args.turns))
+    print(json.dumps({"results": results, "parity_trials": args.trials, "parity_mismatches": mismatches}, indent=2))
+    if args.check_parity and mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from constants import DEFAULT_CHAT_TOKEN_BUDGET, DEFAULT_REPORT_TOKEN_BUDGET, DEFAULT_REPORT_MAX_QUEUE, DEFAULT_REPORT_MAX_QUEUE_WAIT, CHARS_PER_TOKEN_ESTIMATE
+from metrics import metrics
+
+
+def estimate_tokens(llm_input, max_tokens):
+    if isinstance(llm_input, list):
+        n_chars = sum(len(message.get("content") or "") for message in llm_input)
+    else:
+        n_chars = len(llm_input or "")
+    return n_chars // CHARS_PER_TOKEN_ESTIMATE + (max_tokens or 0)
+
+
+class Lane:
+    def __init__(self, name, token_budget, max_queue=None, max_wait=None):
+        self.name = name
+        self.token_budget = token_budget
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight_tokens = 0
+        self.in_flight = 0
+        self.waiting = 0
+
+    def fits(self, tokens):
+        # A lane always admits one request, so a single job larger than the budget is not starved.
+        return not self.token_budget or self.in_flight == 0 or self.in_flight_tokens + tokens <= self.token_budget
+
+
+class AdmissionScheduler:
+    def __init__(self):
+        self.chat = Lane("chat", int(os.getenv("CHAT_TOKEN_BUDGET", DEFAULT_CHAT_TOKEN_BUDGET)))
+        self.report = Lane("report", int(os.getenv("REPORT_TOKEN_BUDGET", DEFAULT_REPORT_TOKEN_BUDGET)),
+                           max_queue=int(os.getenv("REPORT_MAX_QUEUE", DEFAULT_REPORT_MAX_QUEUE)),
+                           max_wait=float(os.getenv("REPORT_MAX_QUEUE_WAIT", DEFAULT_REPORT_MAX_QUEUE_WAIT)))
+        self.lanes = {"chat": self.chat, "report": self.report}
+        self._changed = None
+
+    @asynccontextmanager
+    async def admit(self, lane_name, tokens):
+        lane = self.lanes[lane_name]
+        start = time.monotonic()
+        if not self._can_admit(lane, tokens):
+            await self._wait(lane, tokens, start)
+        wait = time.monotonic() - start
+
+        lane.in_flight += 1
+        lane.in_flight_tokens += tokens
+        metrics.observe(f"admission_{lane.name}_queue_wait_ms", wait * 1000)
+        metrics.set(f"admission_{lane.name}_in_flight_tokens", lane.in_flight_tokens)
+        try:
+            yield wait
+        finally:
+            lane.in_flight -= 1
+            lane.in_flight_tokens -= tokens
+            metrics.set(f"admission_{lane.name}_in_flight_tokens", lane.in_flight_tokens)
+            self._notify()
+
+    def _can_admit(self, lane, tokens):
+        if lane is self.report and self.chat.waiting > 0:
+            return False
+        return lane.fits(tokens)
+
+    async def _wait(self, lane, tokens, start):
+        if lane.max_queue is not None and lane.waiting >= lane.max_queue:
+            self._shed(lane, tokens, f"its queue is full ({lane.waiting} waiting)")
+        lane.waiting += 1
+        metrics.set(f"admission_{lane.name}_waiting", lane.waiting)
+        try:
+            while not self._can_admit(lane, tokens):
+                timeout = None if lane.max_wait is None else start + lane.max_wait - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    self._shed(lane, tokens, f"it waited {lane.max_wait}s without capacity")
+                if self._changed is None:
+                    self._changed = asyncio.Event()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            lane.waiting -= 1
+            metrics.set(f"admission_{lane.name}_waiting", lane.waiting)
+            self._notify()
+
+    def _notify(self):
+        if self._changed is not None:
+            changed, self._changed = self._changed, None
+            changed.set()
+
+    def _shed(self, lane, tokens, reason):
+        metrics.inc(f"admission_{lane.name}_shed")
+        logging.warning("Shedding %s request of ~%s tokens because %s", lane.name, tokens, reason)
+        raise ValueError(
+            f"The {lane.name} lane is over its token budget of {lane.token_budget} "
+            f"({lane.in_flight_tokens} tokens in flight) and {reason}, please retry later"
+        )
@@ -0,0 +1,177 @@
+import os
+import time
+import asyncio
+import hashlib
+from array import array
+from collections import OrderedDict
+from constants import DEFAULT_RESPONSE_CACHE_MAX_ENTRIES, DEFAULT_RESPONSE_CACHE_TTL_SECONDS, DEFAULT_RESPONSE_CACHE_MAX_BYTES
+from metrics import metrics
+
+
+class CachedOutput:
+    __slots__ = ("index", "text", "token_ids", "finish_reason", "logprobs")
+
+    def __init__(self, index, text, token_ids, finish_reason):
+        self.index = index
+        self.text = text
+        self.token_ids = token_ids
+        self.finish_reason = finish_reason
+        self.logprobs = None
+
+
+class CachedRequestOutput:
+    __slots__ = ("request_id", "prompt_token_ids", "outputs", "finished")
+
+    def __init__(self, request_id, prompt_token_ids, outputs, finished):
+        self.request_id = request_id
+        self.prompt_token_ids = prompt_token_ids
+        self.outputs = outputs
+        self.finished = finished
+
+
+class CachedGeneration:
+    def __init__(self, prompt_token_ids, texts, token_ids, finish_reasons, steps):
+        self.prompt_token_ids = prompt_token_ids
+        self.texts = texts
+        self.token_ids = token_ids
+        self.finish_reasons = finish_reasons
+        self.steps = steps
+        self.nbytes = (sum(len(text) for text in texts) + 4 * sum(len(ids) for ids in token_ids)
+                       + 4 * len(prompt_token_ids) + 16 * sum(len(step) for step in steps))
+        self.created = time.monotonic()
+
+    def replay(self, request_id):
+        texts, token_ids, finish_reasons = self.texts, self.token_ids, self.finish_reasons
+        last_step = len(self.steps) - 1
+        for step_index, step in enumerate(self.steps):
+            finished = step_index == last_step
+            outputs = [
+                CachedOutput(index, texts[index][:end], token_ids[index], finish_reasons[index] if finished else None)
+                for index, end in step
+            ]
+            yield CachedRequestOutput(request_id, self.prompt_token_ids, outputs, finished)
+
+
+class GenerationRecorder:
+    def __init__(self):
+        self.prompt_token_ids = None
+        self.steps = []
+        self.last_outputs = {}
+
+    def add(self, request_output):
+        if self.prompt_token_ids is None:
+            self.prompt_token_ids = list(request_output.prompt_token_ids)
+        step = []
+        for output in request_output.outputs:
+            step.append((output.index, len(output.text)))
+            self.last_outputs[output.index] = output
+        self.steps.append(tuple(step))
+
+    def finish(self):
+        if not self.steps:
+            return None
+        n = max(self.last_outputs) + 1
+        outputs = [self.last_outputs.get(index) for index in range(n)]
+        return CachedGeneration(
+            self.prompt_token_ids,
+            [output.text if output else "" for output in outputs],
+            [list(output.token_ids) if output else [] for output in outputs],
+            [output.finish_reason if output else None for output in outputs],
+            self.steps,
+        )
+
+
+class ResponseCache:
+    def __init__(self, max_entries=None, ttl=None, max_bytes=None):
+        self.enabled = bool(int(os.getenv("ENABLE_RESPONSE_CACHE", 1)))
+        self.max_entries = max_entries or int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", DEFAULT_RESPONSE_CACHE_MAX_ENTRIES))
+        self.ttl = ttl or float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", DEFAULT_RESPONSE_CACHE_TTL_SECONDS))
+        self.max_bytes = max_bytes or int(os.getenv("RESPONSE_CACHE_MAX_BYTES", DEFAULT_RESPONSE_CACHE_MAX_BYTES))
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+
+    def make_key(self, prompt, prompt_token_ids, sampling_params):
+        # Only greedy/beam generations are reproducible, and logprobs are not recorded.
+        if not self.enabled or sampling_params.logprobs is not None or sampling_params.prompt_logprobs is not None:
+            return None
+        if sampling_params.temperature > 1e-5 and not sampling_params.use_beam_search:
+            return None
+        digest = hashlib.sha256(repr(sampling_params).encode())
+        if prompt_token_ids is not None:
+            digest.update(array("i", prompt_token_ids).tobytes())
+        else:
+            digest.update(prompt.encode())
+        return digest.hexdigest()
+
+    async def generate(self, key, request_id, start, deadline=None):
+        while True:
+            entry = self._get(key)
+            if entry is None and key in self.inflight:
+                self._count("coalesced")
+                entry = await self._wait_inflight(key, request_id, deadline)
+            if entry is not None:
+                for request_output in entry.replay(request_id):
+                    yield request_output
+                return
+            if key not in self.inflight:
+                break
+
+        self._count("misses")
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        recorder, entry, results = GenerationRecorder(), None, start()
+        try:
+            async for request_output in results:
+                recorder.add(request_output)
+                yield request_output
+            entry = recorder.finish()
+            if entry is not None:
+                self._put(key, entry)
+        finally:
+            await results.aclose()
+            del self.inflight[key]
+            future.set_result(entry)
+
+    async def _wait_inflight(self, key, request_id, deadline):
+        # A follower keeps its own deadline, the leader's request runs on regardless.
+        timeout = max(deadline - time.monotonic(), 0) if deadline is not None else None
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.inflight[key]), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Request {request_id} passed its deadline waiting for an identical request") from None
+
+    def get_stats(self):
+        lookups = self.stats["hits"] + self.stats["coalesced"] + self.stats["misses"]
+        hit_rate = (self.stats["hits"] + self.stats["coalesced"]) / lookups if lookups else 0.0
+        return dict(self.stats, entries=len(self.entries), bytes=self.nbytes, hit_rate=hit_rate)
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created > self.ttl:
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        self._count("hits")
+        return entry
+
+    def _put(self, key, entry):
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = entry
+        self.nbytes += entry.nbytes
+        while self.entries and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+            self._count("evictions")
+        metrics.set("response_cache_bytes", self.nbytes)
+        metrics.set("response_cache_entries", len(self.entries))
+
+    def _remove(self, key):
+        self.nbytes -= self.entries.pop(key).nbytes
+
+    def _count(self, name):
+        self.stats[name] += 1
+        metrics.inc(f"response_cache_{name}")
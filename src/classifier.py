@@ -0,0 +1,481 @@
+import os
+import re
+import atexit
+import asyncio
+import logging
+import threading
+import multiprocessing
+from types import SimpleNamespace
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import torch
+from transformers import BertForSequenceClassification, BertTokenizerFast
+from constants import DEFAULT_CLASSIFIER_MODEL_NAME, DEFAULT_CLASSIFIER_MAX_BATCH_SIZE, DEFAULT_CLASSIFIER_MAX_WAIT_MS, NUM_INTENT_LABELS, DEFAULT_CLASSIFIER_CACHE_SIZE, DEFAULT_CLASSIFIER_CACHE_SNAPSHOT_EVERY, CLASSIFIER_MAX_SEQ_LEN, DEFAULT_CLASSIFIER_POOL_THREADS
+from metrics import metrics
+from utils import get_local_model_path
+
+
+class IntentClassifier:
+    backend = "torch"
+
+    def __init__(self, model_name=None, device=None):
+        self.model_name = model_name or os.getenv("CLASSIFIER_MODEL_NAME", DEFAULT_CLASSIFIER_MODEL_NAME)
+        self.model_path = get_local_model_path("classifier", self.model_name)
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.tokenizer = BertTokenizerFast.from_pretrained(self.model_path, do_lower_case=True)
+        self.model = BertForSequenceClassification.from_pretrained(self.model_path,
+                                                                   num_labels=NUM_INTENT_LABELS,
+                                                                   output_attentions=False,
+                                                                   output_hidden_states=False)
+        self.model.to(self.device)
+        self.model.eval()
+        if self.device.type == "cpu" and os.getenv("CLASSIFIER_NUM_THREADS"):
+            torch.set_num_threads(int(os.getenv("CLASSIFIER_NUM_THREADS")))
+        logging.info("Loaded intent classifier %s on %s (%s backend)", self.model_name, self.device, self.backend)
+
+    def predict(self, texts):
+        return self.predict_encoded(self.tokenizer(texts, padding=True, truncation=True, return_tensors='np'))
+
+    def predict_encoded(self, encoded_input):
+        encoded_input = {name: torch.from_numpy(value).to(self.device) for name, value in encoded_input.items()}
+        with torch.inference_mode():
+            logits = self.model(**encoded_input).logits
+        return logits.float().cpu().numpy()
+
+
+class QuantizedIntentClassifier(IntentClassifier):
+    backend = "torch_int8"
+
+    def __init__(self, model_name=None, device=None):
+        # Dynamic int8 quantization only has CPU kernels.
+        super().__init__(model_name, device="cpu")
+        self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class OnnxIntentClassifier:
+    backend = "onnx"
+
+    def __init__(self, model_name=None, onnx_path=None, device=None):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("CLASSIFIER_BACKEND=onnx requires onnxruntime, install it with `pip install onnxruntime`") from e
+
+        self.model_name = model_name or os.getenv("CLASSIFIER_MODEL_NAME", DEFAULT_CLASSIFIER_MODEL_NAME)
+        self.onnx_path = onnx_path or os.getenv("CLASSIFIER_ONNX_PATH") or os.path.join(
+            os.getenv("HF_HOME", "/tmp"), self.model_name.replace("/", "--") + ".onnx")
+        self.tokenizer = BertTokenizerFast.from_pretrained(get_local_model_path("classifier", self.model_name), do_lower_case=True)
+        if not os.path.exists(self.onnx_path):
+            self.export(self.onnx_path)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        intra_op_threads = os.getenv("CLASSIFIER_NUM_THREADS")
+        if intra_op_threads:
+            options.intra_op_num_threads = int(intra_op_threads)
+        providers = ["CPUExecutionProvider"] if device == "cpu" else onnxruntime.get_available_providers()
+        self.session = onnxruntime.InferenceSession(self.onnx_path, options, providers=providers)
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        logging.info("Loaded intent classifier %s from %s (%s backend)", self.model_name, self.onnx_path, self.backend)
+
+    def export(self, path):
+        model = IntentClassifier(self.model_name, device="cpu").model
+        sample = self.tokenizer(["warm up"], return_tensors="pt")
+        # Graph inputs are named positionally, so follow BertForSequenceClassification.forward's order.
+        input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["logits"] = {0: "batch"}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with torch.no_grad():
+            torch.onnx.export(model, (dict(sample),), tmp_path, input_names=input_names, output_names=["logits"],
+                              dynamic_axes=dynamic_axes, opset_version=14)
+        os.replace(tmp_path, path)
+        logging.info("Exported intent classifier %s to %s", self.model_name, path)
+
+    def predict(self, texts):
+        return self.predict_encoded(self.tokenizer(texts, padding=True, truncation=True, return_tensors='np'))
+
+    def predict_encoded(self, encoded_input):
+        feed = {name: value.astype(np.int64) for name, value in encoded_input.items() if name in self.input_names}
+        return self.session.run(["logits"], feed)[0].astype(np.float32)
+
+
+CLASSIFIER_BACKENDS = {
+    "torch": IntentClassifier,
+    "torch_int8": QuantizedIntentClassifier,
+    "onnx": OnnxIntentClassifier,
+}
+
+
+def load_classifier(backend=None, device=None):
+    backend = (backend or os.getenv("CLASSIFIER_BACKEND", "torch")).lower()
+    if backend not in CLASSIFIER_BACKENDS:
+        raise ValueError(f"Unknown CLASSIFIER_BACKEND '{backend}', must be one of {list(CLASSIFIER_BACKENDS)}")
+    return CLASSIFIER_BACKENDS[backend](device=device)
+
+
+def load_cpu_classifier():
+    return load_classifier(device="cpu")
+
+
+CLASSIFIER_INPUT_NAMES = ("input_ids", "attention_mask", "token_type_ids")
+
+
+def _shared_arrays(buffer, max_batch_size, max_seq_len, batch_size, seq_len, names):
+    # One fixed region per input name and one for the logits, each batch is written contiguously at its start.
+    region = max_batch_size * max_seq_len * 8
+    inputs = {
+        name: np.ndarray((batch_size, seq_len), dtype=np.int64, buffer=buffer, offset=CLASSIFIER_INPUT_NAMES.index(name) * region)
+        for name in names
+    }
+    logits = np.ndarray((batch_size, NUM_INTENT_LABELS), dtype=np.float32, buffer=buffer, offset=len(CLASSIFIER_INPUT_NAMES) * region)
+    return inputs, logits
+
+
+def _serve_classifier(factory, num_threads, shm_name, max_batch_size, max_seq_len, conn):
+    # Pool processes run next to vLLM on the same GPU, so they never open a CUDA context of their own.
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+    os.environ["CLASSIFIER_NUM_THREADS"] = str(num_threads)
+    try:
+        classifier = factory()
+    except Exception as e:
+        conn.send(f"{type(e).__name__}: {e}")
+        return
+    shm = SharedMemory(name=shm_name)
+    conn.send(None)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        inputs, logits = _shared_arrays(shm.buf, max_batch_size, max_seq_len, *message)
+        try:
+            logits[:] = classifier.predict_encoded(inputs)
+            conn.send(None)
+        except Exception as e:
+            conn.send(f"{type(e).__name__}: {e}")
+        del inputs, logits
+    shm.close()
+
+
+# Runs the classifier in dedicated processes, off the GIL of the event loop that streams LLM output.
+# Token ids and logits travel through one shared memory block per process, the pipe only carries batch shapes.
+class ClassifierPool:
+    backend = "process_pool"
+
+    def __init__(self, max_batch_size, n_processes=None, num_threads=None, factory=load_cpu_classifier, tokenizer=None, max_seq_len=CLASSIFIER_MAX_SEQ_LEN):
+        self.max_batch_size = max_batch_size
+        self.n_processes = n_processes or int(os.getenv("CLASSIFIER_PROCESSES", 1))
+        self.num_threads = num_threads or int(os.getenv("CLASSIFIER_NUM_THREADS", DEFAULT_CLASSIFIER_POOL_THREADS))
+        self.factory = factory
+        self.tokenizer = tokenizer
+        self.max_seq_len = max_seq_len
+        self.workers = []
+        self._context = multiprocessing.get_context("spawn")
+        self._start_lock = threading.Lock()
+        self._idle = None
+
+    def start(self):
+        with self._start_lock:
+            if self.workers:
+                return
+            if self.tokenizer is None:
+                model_name = os.getenv("CLASSIFIER_MODEL_NAME", DEFAULT_CLASSIFIER_MODEL_NAME)
+                self.tokenizer = BertTokenizerFast.from_pretrained(get_local_model_path("classifier", model_name), do_lower_case=True)
+            size = self.max_batch_size * (len(CLASSIFIER_INPUT_NAMES) * self.max_seq_len * 8 + NUM_INTENT_LABELS * 4)
+            workers = [SimpleNamespace(index=index, shm=SharedMemory(create=True, size=size), process=None, conn=None)
+                       for index in range(self.n_processes)]
+            self.workers = workers
+            atexit.register(self.close)
+            for worker in workers:
+                self._spawn(worker)
+            for worker in workers:
+                self._wait_ready(worker)
+            logging.info("Started %s classifier processes with %s threads each", self.n_processes, self.num_threads)
+
+    def warmup(self):
+        self.start()
+        for worker in self.workers:
+            worker.conn.send(self._write_inputs(worker, ["warm up"]))
+            error = worker.conn.recv()
+            if error:
+                raise RuntimeError(f"Classifier process {worker.index} failed to warm up: {error}")
+
+    async def acquire(self):
+        if not self.workers:
+            await asyncio.get_running_loop().run_in_executor(None, self.start)
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for worker in self.workers:
+                self._idle.put_nowait(worker)
+        return await self._idle.get()
+
+    def release(self, worker):
+        self._idle.put_nowait(worker)
+
+    async def predict(self, worker, texts):
+        loop = asyncio.get_running_loop()
+        message = await loop.run_in_executor(None, self._write_inputs, worker, texts)
+        future = loop.create_future()
+        fd = worker.conn.fileno()
+        loop.add_reader(fd, self._on_reply, worker, future)
+        try:
+            worker.conn.send(message)
+            error = await future
+        finally:
+            loop.remove_reader(fd)
+        if error:
+            raise RuntimeError(f"Classifier process {worker.index} failed: {error}")
+        return _shared_arrays(worker.shm.buf, self.max_batch_size, self.max_seq_len, *message)[1].copy()
+
+    async def recover(self, worker):
+        if not worker.process.is_alive():
+            logging.warning("Classifier process %s exited with %s, restarting it", worker.index, worker.process.exitcode)
+            await asyncio.get_running_loop().run_in_executor(None, self._restart, worker)
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.shm.close()
+            worker.shm.unlink()
+        self.workers = []
+
+    def _spawn(self, worker):
+        worker.conn, child_conn = self._context.Pipe()
+        worker.process = self._context.Process(
+            target=_serve_classifier, name=f"classifier-{worker.index}", daemon=True,
+            args=(self.factory, self.num_threads, worker.shm.name, self.max_batch_size, self.max_seq_len, child_conn),
+        )
+        worker.process.start()
+        child_conn.close()
+
+    def _wait_ready(self, worker):
+        try:
+            error = worker.conn.recv()
+        except EOFError:
+            worker.process.join(timeout=5)
+            error = f"exited with {worker.process.exitcode}"
+        if error:
+            raise RuntimeError(f"Classifier process {worker.index} failed to start: {error}")
+
+    def _restart(self, worker):
+        worker.conn.close()
+        self._spawn(worker)
+        self._wait_ready(worker)
+
+    def _write_inputs(self, worker, texts):
+        if len(texts) > self.max_batch_size:
+            raise ValueError(f"Classifier batch of {len(texts)} is over the pool's max batch size of {self.max_batch_size}")
+        encoded = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_seq_len, return_tensors="np")
+        names = tuple(name for name in CLASSIFIER_INPUT_NAMES if name in encoded)
+        batch_size, seq_len = encoded["input_ids"].shape
+        inputs, _ = _shared_arrays(worker.shm.buf, self.max_batch_size, self.max_seq_len, batch_size, seq_len, names)
+        for name in names:
+            inputs[name][:] = encoded[name]
+        return batch_size, seq_len, names
+
+    @staticmethod
+    def _on_reply(worker, future):
+        try:
+            reply = worker.conn.recv()
+        except EOFError:
+            reply = f"exited with {worker.process.exitcode}"
+        if not future.done():
+            future.set_result(reply)
+
+
+class LogitsCache:
+    def __init__(self, capacity=None, snapshot_path=None, snapshot_every=None):
+        self.capacity = capacity if capacity is not None else int(os.getenv("CLASSIFIER_CACHE_SIZE", DEFAULT_CLASSIFIER_CACHE_SIZE))
+        self.snapshot_path = snapshot_path or os.getenv("CLASSIFIER_CACHE_PATH")
+        self.snapshot_every = snapshot_every or int(os.getenv("CLASSIFIER_CACHE_SNAPSHOT_EVERY", DEFAULT_CLASSIFIER_CACHE_SNAPSHOT_EVERY))
+        self.logits = np.zeros((self.capacity, NUM_INTENT_LABELS), dtype=np.float16)
+        self.slots = OrderedDict()
+        self.free_slots = list(range(self.capacity - 1, -1, -1))
+        self.stats = {"hits": 0, "misses": 0}
+        self.unsaved = 0
+        self._snapshot_lock = threading.Lock()
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            self.load(self.snapshot_path)
+
+    @staticmethod
+    def normalize(text):
+        return re.sub(r"\s+", " ", text).strip().lower()
+
+    def get(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            self._count("misses")
+            return None
+        self.slots.move_to_end(key)
+        self._count("hits")
+        return self.logits[slot].astype(np.float32)
+
+    def put(self, key, logits):
+        if self.capacity <= 0:
+            return
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.free_slots.pop() if self.free_slots else self.slots.pop(next(iter(self.slots)))
+            self.slots[key] = slot
+        self.logits[slot] = logits
+        self.unsaved += 1
+        if self.snapshot_path and self.unsaved >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        keys = list(self.slots)
+        logits = self.logits[list(self.slots.values())]
+        self.unsaved = 0
+        threading.Thread(target=self.save, args=(self.snapshot_path, keys, logits), daemon=True).start()
+
+    def save(self, path, keys, logits):
+        with self._snapshot_lock:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, keys=np.array(keys, dtype=str), logits=logits)
+            os.replace(tmp_path, path)
+
+    def load(self, path):
+        try:
+            with np.load(path) as snapshot:
+                keys, logits = snapshot["keys"], snapshot["logits"]
+        except Exception as e:
+            logging.warning("Could not load classifier cache snapshot %s: %s", path, e)
+            return
+        for key, row in zip(keys[-self.capacity:], logits[-self.capacity:]):
+            self.put(str(key), row)
+        self.unsaved = 0
+        logging.info("Warmed classifier cache with %s entries from %s", len(self.slots), path)
+
+    def get_stats(self):
+        return dict(self.stats, entries=len(self.slots), capacity=self.capacity)
+
+    def _count(self, name):
+        self.stats[name] += 1
+        metrics.inc(f"classifier_cache_{name}")
+
+
+class BatchedClassifier:
+    def __init__(self, classifier=None, max_batch_size=None, max_wait_ms=None, cache=None):
+        self.cache = cache if cache is not None else LogitsCache()
+        self.max_batch_size = max_batch_size or int(os.getenv("CLASSIFIER_MAX_BATCH_SIZE", DEFAULT_CLASSIFIER_MAX_BATCH_SIZE))
+        if classifier is None and int(os.getenv("CLASSIFIER_PROCESSES", 0)) > 0:
+            classifier = ClassifierPool(self.max_batch_size)
+        self.classifier = classifier
+        self.pool = classifier if isinstance(classifier, ClassifierPool) else None
+        self._pool_tasks = set()
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else float(os.getenv("CLASSIFIER_MAX_WAIT_MS", DEFAULT_CLASSIFIER_MAX_WAIT_MS))) / 1000
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="classifier")
+        self._queue = None
+        self._worker = None
+
+    async def classify(self, text):
+        key = self.cache.normalize(text)
+        logits = self.cache.get(key)
+        if logits is not None:
+            return logits
+
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        metrics.set("classifier_queue_depth", self._queue.qsize())
+        logits = await future
+        self.cache.put(key, logits)
+        return logits
+
+    async def classify_many(self, texts):
+        if not texts:
+            return np.zeros((0, NUM_INTENT_LABELS), dtype=np.float32)
+        return np.stack(await asyncio.gather(*[self.classify(text) for text in texts]))
+
+    def warmup(self):
+        # Loads the model and runs one forward pass on the classifier thread, or in every pool process, before serving.
+        if self.pool is not None:
+            self.pool.warmup()
+        else:
+            self.executor.submit(self._predict, ["warm up"]).result()
+
+    def _ensure_started(self):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    def _predict(self, texts):
+        if self.classifier is None:
+            self.classifier = load_classifier()
+        return self.classifier.predict(texts)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # With a process pool the next batch keeps filling up while every process is busy.
+            worker = await self.pool.acquire() if self.pool is not None else None
+            batch = [await self._queue.get()]
+            window_start = loop.time()
+            deadline = window_start + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            metrics.observe("classifier_batch_size", len(batch))
+            metrics.observe("classifier_wait_window_ms", (loop.time() - window_start) * 1000)
+            metrics.set("classifier_queue_depth", self._queue.qsize())
+
+            texts = [text for text, _ in batch]
+            if worker is not None:
+                task = loop.create_task(self._classify_on_pool(worker, batch, texts))
+                self._pool_tasks.add(task)
+                task.add_done_callback(self._pool_tasks.discard)
+                continue
+            try:
+                logits = await loop.run_in_executor(self.executor, self._predict, texts)
+            except Exception as e:
+                self._fail(batch, e)
+                continue
+            self._resolve(batch, logits)
+
+    async def _classify_on_pool(self, worker, batch, texts):
+        try:
+            logits = await self.pool.predict(worker, texts)
+        except Exception as e:
+            self._fail(batch, e)
+            await self.pool.recover(worker)
+        else:
+            self._resolve(batch, logits)
+        finally:
+            self.pool.release(worker)
+
+    @staticmethod
+    def _resolve(batch, logits):
+        for row, (_, future) in zip(logits, batch):
+            if not future.done():
+                future.set_result(row)
+
+    @staticmethod
+    def _fail(batch, e):
+        logging.error("Intent classification failed for a batch of %s: %s", len(batch), e)
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
@@ -0,0 +1,65 @@
+import os
+import time
+import logging
+from statistics import median
+from constants import DEFAULT_MIN_CONCURRENCY, DEFAULT_CONCURRENCY_SAMPLE_INTERVAL, DEFAULT_CONCURRENCY_PATIENCE, DEFAULT_TARGET_TTFT_MS
+from metrics import metrics
+
+
+class ConcurrencyController:
+    def __init__(self, engine, floor=None, ceiling=None, sample_interval=None, patience=None, target_ttft_ms=None):
+        self.engine = engine
+        self.ceiling = ceiling or engine.max_concurrency
+        self.floor = min(floor or int(os.getenv("MIN_CONCURRENCY", DEFAULT_MIN_CONCURRENCY)), self.ceiling)
+        self.sample_interval = sample_interval or float(os.getenv("CONCURRENCY_SAMPLE_INTERVAL", DEFAULT_CONCURRENCY_SAMPLE_INTERVAL))
+        self.patience = patience or int(os.getenv("CONCURRENCY_PATIENCE", DEFAULT_CONCURRENCY_PATIENCE))
+        self.target_ttft = (target_ttft_ms or float(os.getenv("TARGET_TTFT_MS", DEFAULT_TARGET_TTFT_MS))) / 1000
+        self.current = self.ceiling
+        self.last_sample_time = 0
+        self.pending_direction = 0
+        self.pending_samples = 0
+        metrics.set("concurrency_advertised", self.current)
+
+    def __call__(self, current_concurrency):
+        now = time.monotonic()
+        if now - self.last_sample_time >= self.sample_interval:
+            self.last_sample_time = now
+            try:
+                self._update()
+            except Exception as e:
+                logging.warning("Could not sample engine load, keeping concurrency at %s: %s", self.current, e)
+        return self.current
+
+    def _update(self):
+        state = self.engine._get_scheduler_state()
+        ttft = median(self.engine.recent_ttfts) if self.engine.recent_ttfts else None
+        for name, value in state.items():
+            metrics.set(f"scheduler_{name}", value)
+
+        if state["waiting"] > 0 or state["swapped"] > 0 or (ttft is not None and ttft > self.target_ttft):
+            direction = -1
+        elif ttft is None or ttft < self.target_ttft / 2:
+            direction = 1
+        else:
+            direction = 0
+
+        if direction == 0 or direction != self.pending_direction:
+            self.pending_direction, self.pending_samples = direction, 0
+        self.pending_samples += direction != 0
+        if self.pending_samples < self.patience:
+            return
+
+        if direction < 0:
+            target = max(self.floor, int(self.current * 0.75))
+        else:
+            target = min(self.ceiling, self.current + max(1, self.current // 10))
+        self.pending_samples = 0
+        if target == self.current:
+            return
+
+        logging.info("Concurrency %s -> %s (waiting=%s swapped=%s running=%s median_ttft_ms=%s)",
+                     self.current, target, state["waiting"], state["swapped"], state["running"],
+                     round(ttft * 1000, 1) if ttft is not None else None)
+        metrics.inc("concurrency_decreases" if direction < 0 else "concurrency_increases")
+        metrics.set("concurrency_advertised", target)
+        self.current = target
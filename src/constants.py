@@ -2,6 +2,7 @@ from typing import Union
 
 DEFAULT_BATCH_SIZE = 30
 DEFAULT_MAX_CONCURRENCY = 300
+DEFAULT_MAX_TOKENS = 16
 
 SAMPLING_PARAM_TYPES = {
     "n": int,
@@ -26,3 +27,54 @@ SAMPLING_PARAM_TYPES = {
     "spaces_between_special_tokens": bool,
     "include_stop_str_in_output": bool
 }
+
+DEFAULT_CLASSIFIER_MODEL_NAME = "meetplace1/bertclassify900"
+NUM_INTENT_LABELS = 15
+DEFAULT_CLASSIFIER_MAX_BATCH_SIZE = 32
+DEFAULT_CLASSIFIER_MAX_WAIT_MS = 5
+
+DEFAULT_SESSION_STORE_MAX_SESSIONS = 10000
+DEFAULT_SESSION_TTL_SECONDS = 1800
+DEFAULT_SESSION_STORE_MAX_BYTES = 256 * 1024 * 1024
+
+DEFAULT_MAX_ADAPTIVE_BATCH_SIZE = 120
+DEFAULT_ADAPTIVE_BATCH_GROWTH = 2
+
+DEFAULT_TTFT_WINDOW = 64
+DEFAULT_MIN_CONCURRENCY = 8
+DEFAULT_CONCURRENCY_SAMPLE_INTERVAL = 1.0
+DEFAULT_CONCURRENCY_PATIENCE = 3
+DEFAULT_TARGET_TTFT_MS = 1000
+
+CHARS_PER_TOKEN_ESTIMATE = 4
+DEFAULT_CHAT_TOKEN_BUDGET = 0
+DEFAULT_REPORT_TOKEN_BUDGET = 32768
+DEFAULT_REPORT_MAX_QUEUE = 32
+DEFAULT_REPORT_MAX_QUEUE_WAIT = 30
+
+DEFAULT_REPORT_CHUNK_TOKENS = 2048
+DEFAULT_REPORT_SUMMARY_MAX_TOKENS = 256
+
+DEFAULT_RESPONSE_CACHE_MAX_ENTRIES = 1024
+DEFAULT_RESPONSE_CACHE_TTL_SECONDS = 600
+DEFAULT_RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+DEFAULT_CLASSIFIER_CACHE_SIZE = 10000
+DEFAULT_CLASSIFIER_CACHE_SNAPSHOT_EVERY = 500
+
+LOCAL_MODELS_MANIFEST = "/local_models.json"
+
+DEFAULT_HISTOGRAM_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+DEFAULT_METRICS_DUMP_INTERVAL = 15
+
+DEFAULT_PROMPT_TOKEN_BUDGET = 0
+
+DEFAULT_MAX_FANOUT = 64
+
+DEFAULT_REQUEST_TIMEOUT = 0
+
+DEFAULT_LOGPROBS_CAPACITY = 256
+LOGPROBS_DECIMALS = 4
+
+CLASSIFIER_MAX_SEQ_LEN = 512
+DEFAULT_CLASSIFIER_POOL_THREADS = 1
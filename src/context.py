@@ -0,0 +1,74 @@
+import os
+import logging
+from constants import DEFAULT_PROMPT_TOKEN_BUDGET
+from metrics import metrics
+
+
+# Only used to weigh messages against each other, so content parts are reduced to their text.
+def content_text(content):
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(part.get("text") or "" for part in content if isinstance(part, dict))
+    return "" if content is None else str(content)
+
+
+class ContextBudget:
+    def __init__(self, tokenizer, max_model_len=None, prompt_budget=None):
+        self.tokenizer = tokenizer
+        self.max_model_len = max_model_len
+        self.prompt_budget = prompt_budget or int(os.getenv("PROMPT_TOKEN_BUDGET", DEFAULT_PROMPT_TOKEN_BUDGET))
+
+    def limit(self, max_tokens):
+        limits = [self.prompt_budget] if self.prompt_budget else []
+        if self.max_model_len:
+            limits.append(self.max_model_len - (max_tokens or 0))
+        return min(limits) if limits else None
+
+    def trim_turns(self, fixed_tokens, turn_lengths, max_tokens):
+        # The prefix and the latest message are always kept, whole turns are dropped oldest first.
+        limit = self.limit(max_tokens)
+        total = fixed_tokens + sum(turn_lengths)
+        n_dropped = 0
+        while limit is not None and total > limit and n_dropped < len(turn_lengths):
+            total -= turn_lengths[n_dropped]
+            n_dropped += 1
+        if limit is not None and total > limit:
+            logging.warning("Prompt of %s tokens is over the budget of %s tokens even without history", total, limit)
+        return n_dropped, sum(turn_lengths[:n_dropped])
+
+    def trim_messages(self, messages, max_tokens):
+        limit = self.limit(max_tokens)
+        if limit is None:
+            return messages, 0, 0
+        prompt = self.tokenizer.apply_chat_template(messages)
+        # Byte-level and byte-fallback tokenizers never need more than one token per UTF-8 byte, so short prompts skip tokenization.
+        if len(prompt.encode()) <= limit:
+            return messages, 0, 0
+        n_tokens = original_tokens = len(self.tokenizer.encode(prompt, add_special_tokens=False))
+
+        n_system = 0
+        while n_system < len(messages) - 1 and messages[n_system].get("role") == "system":
+            n_system += 1
+        system, turns = messages[:n_system], messages[n_system:]
+        lengths = [len(ids) for ids in self.tokenizer.encode_batch([content_text(message.get("content")) for message in messages])]
+        # Chat templates add a few tokens per message, so the estimate is checked against the rendered prompt.
+        overhead = max(n_tokens - sum(lengths), 0) / len(messages)
+        lengths = [length + overhead for length in lengths[n_system:]]
+        n_dropped = 0
+        while n_tokens > limit and n_dropped < len(turns) - 1:
+            excess = n_tokens - limit
+            while excess > 0 and n_dropped < len(turns) - 1:
+                excess -= lengths[n_dropped]
+                n_dropped += 1
+            n_tokens = len(self.tokenizer.encode(self.tokenizer.apply_chat_template(system + turns[n_dropped:]), add_special_tokens=False))
+        if n_tokens > limit:
+            logging.warning("Prompt of %s tokens is over the budget of %s tokens even with only the latest message", n_tokens, limit)
+        return system + turns[n_dropped:], n_dropped, original_tokens - n_tokens
+
+    @staticmethod
+    def usage(trimmed_turns, trimmed_tokens):
+        if trimmed_turns:
+            metrics.inc("context_trimmed_turns", trimmed_turns)
+            metrics.inc("context_trimmed_tokens", trimmed_tokens)
+        return {"trimmed_turns": trimmed_turns, "trimmed_tokens": trimmed_tokens}
@@ -1,25 +1,119 @@
 import os
+import json
+import shutil
+import hashlib
 import logging
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from huggingface_hub import HfApi, snapshot_download
 from vllm.model_executor.weight_utils import prepare_hf_model_weights
+from constants import DEFAULT_CLASSIFIER_MODEL_NAME, LOCAL_MODELS_MANIFEST
+
+TOKENIZER_PATTERNS = ["*.json", "*.model", "*.txt", "*.tiktoken", "*.py"]
+
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def checksum_folder(folder):
+    checksums = {}
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            checksums[os.path.relpath(path, folder)] = sha256sum(path)
+    return checksums
+
+
+def fetch(name, download_dir, mirror_dir, allow_patterns=None):
+    if not mirror_dir:
+        return snapshot_download(name, allow_patterns=allow_patterns, cache_dir=download_dir)
+
+    # A local directory laid out as <mirror_dir>/<org>/<name> stands in for the hub.
+    source = os.path.join(mirror_dir, name)
+    folder = os.path.join(download_dir, "mirror--" + name.replace("/", "--"))
+    for root, _, files in os.walk(source):
+        for file in files:
+            path = os.path.relpath(os.path.join(root, file), source)
+            if allow_patterns is None or any(fnmatch(path, pattern) for pattern in allow_patterns):
+                os.makedirs(os.path.dirname(os.path.join(folder, path)), exist_ok=True)
+                shutil.copyfile(os.path.join(source, path), os.path.join(folder, path))
+    return folder
+
+
+def verify(name, folder, mirror_dir):
+    # The hub publishes sha256 for LFS files (the weights); a mirror is compared file by file.
+    checksums = checksum_folder(folder)
+    if mirror_dir:
+        source = os.path.join(mirror_dir, name)
+        expected = {path: sha256sum(os.path.join(source, path)) for path in checksums}
+    else:
+        info = HfApi().model_info(name, files_metadata=True)
+        expected = {sibling.rfilename: sibling.lfs.sha256 for sibling in info.siblings if sibling.lfs}
+    for path, checksum in checksums.items():
+        if path in expected and expected[path] != checksum:
+            raise ValueError(f"Checksum mismatch for {name}/{path} in {folder}: expected {expected[path]}, got {checksum}")
+    logging.info("Verified %s of %s files of %s", sum(path in expected for path in checksums), len(checksums), name)
+    return {"name": name, "path": folder, "files": checksums}
+
+
+def download_llm(model, download_dir, mirror_dir):
+    if mirror_dir:
+        return verify(model, fetch(model, download_dir, mirror_dir), mirror_dir)
+    hf_folder, _, _ = prepare_hf_model_weights(model_name_or_path=model, cache_dir=download_dir)
+    # prepare_hf_model_weights only fetches the weights, the config and tokenizer files go in the same snapshot.
+    fetch(model, download_dir, mirror_dir, TOKENIZER_PATTERNS)
+    return verify(model, hf_folder, mirror_dir)
+
+
+def download_tokenizer(tokenizer, download_dir, mirror_dir):
+    return verify(tokenizer, fetch(tokenizer, download_dir, mirror_dir, TOKENIZER_PATTERNS), mirror_dir)
+
+
+def download_classifier(classifier, download_dir, mirror_dir):
+    from transformers import BertForSequenceClassification, BertTokenizerFast
+
+    # Re-saved as safetensors so the worker memory-maps the weights instead of unpickling them.
+    folder = verify(classifier, fetch(classifier, download_dir, mirror_dir), mirror_dir)["path"]
+    output_dir = os.path.join(download_dir, "classifier--" + classifier.replace("/", "--"))
+    tmp_dir = output_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    BertForSequenceClassification.from_pretrained(folder).save_pretrained(tmp_dir, safe_serialization=True)
+    BertTokenizerFast.from_pretrained(folder).save_pretrained(tmp_dir)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+    return {"name": classifier, "path": output_dir, "files": checksum_folder(output_dir)}
+
 
 if __name__ == "__main__":
     model = os.getenv("MODEL_NAME")
     download_dir = os.getenv("HF_HOME")
     if not model or not download_dir:
         raise ValueError(f"Must specify model and download_dir. Model: {model}, download_dir: {download_dir}")
+    tokenizer = os.getenv("TOKENIZER_NAME")
+    classifier = os.getenv("CLASSIFIER_MODEL_NAME", DEFAULT_CLASSIFIER_MODEL_NAME)
+    mirror_dir = os.getenv("HUB_MIRROR_DIR")
 
     if not os.path.exists(download_dir):
         os.makedirs(download_dir)
-    
-    logging.info(f"Downloading model {model} to {download_dir}")
-        
-    hf_folder, hf_weights_files, use_safetensors = prepare_hf_model_weights(
-        model_name_or_path=model,
-        cache_dir=download_dir,
-    )
-    
+
+    logging.info(f"Downloading model {model}, tokenizer {tokenizer or model} and classifier {classifier} to {download_dir}")
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = {"llm": pool.submit(download_llm, model, download_dir, mirror_dir),
+                   "classifier": pool.submit(download_classifier, classifier, download_dir, mirror_dir)}
+        if tokenizer:
+            futures["tokenizer"] = pool.submit(download_tokenizer, tokenizer, download_dir, mirror_dir)
+        manifest = {role: future.result() for role, future in futures.items()}
+
     logging.info(f"Finished downloading model {model} to {download_dir}")
-    
+
     # Wrie hf_folder to file
     with open("/local_model_path.txt", "w") as f:
-        f.write(hf_folder) 
\ No newline at end of file
+        f.write(manifest["llm"]["path"])
+    with open(LOCAL_MODELS_MANIFEST, "w") as f:
+        json.dump(manifest, f, indent=2)
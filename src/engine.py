@@ -1,16 +1,37 @@
 import os
+import time
+import asyncio
 import logging
 from typing import Union, AsyncGenerator
 import json
+from collections import deque
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
 from torch.cuda import device_count
 from vllm import AsyncLLMEngine, AsyncEngineArgs, SamplingParams
 from vllm.entrypoints.openai.serving_chat import OpenAIServingChat
 from vllm.entrypoints.openai.protocol import ChatCompletionRequest
 from transformers import AutoTokenizer
-from utils import count_physical_cores, DummyRequest
-from constants import DEFAULT_MAX_CONCURRENCY
+from utils import count_physical_cores, get_local_model_path, DummyRequest
+from personas import PersonaRegistry
+from sessions import Session, SessionStore
+from cache import ResponseCache
+from report import ReportBuilder
+from stream import StreamAggregator, CompactStreamAggregator, OpenAIStreamAggregator, FlushPolicy
+from admission import AdmissionScheduler, estimate_tokens
+from context import ContextBudget
+from router import EngineRouter, get_scheduler_state
+from constants import DEFAULT_MAX_CONCURRENCY, DEFAULT_TTFT_WINDOW, DEFAULT_MAX_TOKENS, DEFAULT_REQUEST_TIMEOUT
+from metrics import metrics
+from tracing import NULL_TRACE
 from dotenv import load_dotenv
 
+# Absolute time.monotonic() deadline of the job being generated, inherited by the tasks it spawns.
+request_deadline = ContextVar("request_deadline", default=None)
+
+# A newline is a token of its own for the supported tokenizers, so the text after it is encoded as it would be mid-prompt.
+CONTINUATION_ANCHOR = "\n"
+
 
 class Tokenizer:
     def __init__(self, model_name):
@@ -19,6 +40,7 @@ class Tokenizer:
         self.has_chat_template = bool(self.tokenizer.chat_template) or bool(self.custom_chat_template)
         if self.custom_chat_template and isinstance(self.custom_chat_template, str):
             self.tokenizer.chat_template = self.custom_chat_template
+        self.anchor_ids = self.tokenizer.encode(CONTINUATION_ANCHOR, add_special_tokens=False)
 
     def apply_chat_template(self, input: Union[str, list[dict[str, str]]]) -> str:
         if isinstance(input, list):
@@ -35,361 +57,139 @@ class Tokenizer:
             input, tokenize=False, add_generation_prompt=True
         )
 
+    def encode(self, text: str, add_special_tokens: bool = True) -> list[int]:
+        return self.tokenizer.encode(text, add_special_tokens=add_special_tokens)
+
+    # Token IDs of text that continues a prompt. SentencePiece tokenizers prepend "▁" to every encode() call, so the text is
+    # encoded behind an anchor whose tokens are then stripped, matching the tokens it gets inside the full prompt string.
+    def encode_continuation(self, text: str) -> list[int]:
+        token_ids = self.tokenizer.encode(CONTINUATION_ANCHOR + text, add_special_tokens=False)
+        if token_ids[:len(self.anchor_ids)] != self.anchor_ids:
+            # The anchor merged with the text, plain encoding has no prefix to strip.
+            return self.encode(text, add_special_tokens=False)
+        return token_ids[len(self.anchor_ids):]
+
+    def decode(self, token_ids: list[int]) -> str:
+        return self.tokenizer.decode(token_ids)
+
+    def encode_batch(self, texts: list[str]) -> list[list[int]]:
+        return self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+
 
 class vLLMEngine:
-    def __init__(self, engine = None):
+    def __init__(self, engine = None, tokenizer = None):
         load_dotenv() # For local development
         self.config = self._initialize_config()
         logging.info("vLLM config: %s", self.config)
-        self.tokenizer = Tokenizer(os.getenv("TOKENIZER_NAME", os.getenv("MODEL_NAME")))
-        self.llm = self._initialize_llm() if engine is None else engine
-        self.openai_engine = self._initialize_openai()
+        self.load_times = {}
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokenizer") as pool:
+            tokenizer_future = None
+            if tokenizer is None:
+                tokenizer_future = pool.submit(self._timed, "tokenizer", Tokenizer, self.config["tokenizer"] or os.getenv("MODEL_NAME"))
+            if engine is None:
+                self.llm = self._timed("llm_engine", self._initialize_llm)
+            else:
+                self.llm = EngineRouter(engine) if isinstance(engine, (list, tuple)) else engine
+            self.tokenizer = tokenizer or tokenizer_future.result()
+        self.replicas = self.llm.replicas if isinstance(self.llm, EngineRouter) else [self.llm]
+        self.personas = self._timed("personas", PersonaRegistry, self.tokenizer)
+        self.sessions = SessionStore()
+        self.openai_engine = self._timed("openai", self._initialize_openai)
         self.max_concurrency = int(os.getenv("MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+        self.request_timeout = float(os.getenv("REQUEST_TIMEOUT", DEFAULT_REQUEST_TIMEOUT))
+        self.recent_ttfts = deque(maxlen=DEFAULT_TTFT_WINDOW)
+        self.stopped_requests = set()
+        self.admission = AdmissionScheduler()
+        self.response_cache = ResponseCache()
+        self.reports = ReportBuilder(self._generate_outputs, self.tokenizer)
+        self.context = ContextBudget(self.tokenizer, self._get_engine_max_model_len())
 
-    async def generate(self, job_input):
+    async def generate(self, job_input, trace=NULL_TRACE):
         generator_args = job_input.__dict__
+        task = generator_args.pop("task")
+        timeout = generator_args.pop("timeout") or self.request_timeout
+        request_deadline.set(time.monotonic() + timeout if timeout else None)
         
         if generator_args.pop("use_openai_format"):
             if self.openai_engine is None:
                 raise ValueError("OpenAI Chat Completion Format is not enabled for this model")
+            if generator_args.pop("output_format") != "default":
+                raise ValueError("output_format must be 'default' with use_openai_format")
             generator = self.generate_openai_chat
-        elif generator_args.pop("task")=="report":
+        elif task=="report":
             generator = self.generate_report
         else:
             generator = self.generate_vllm        
         
-        async for batch in generator(**generator_args):
-            yield batch
+        lane = "report" if generator == self.generate_report else "chat"
+        max_tokens = generator_args["validated_sampling_params"].get("max_tokens", DEFAULT_MAX_TOKENS)
+        tokens = self._estimate_admission_tokens(generator, generator_args, max_tokens)
+        async with self.admission.admit(lane, tokens) as queue_wait:
+            trace.record("admission_wait", time.monotonic() - queue_wait, queue_wait)
+            async for batch in generator(**generator_args, trace=trace):
+                if "usage" in batch:
+                    batch["usage"]["queue_wait_ms"] = round(queue_wait * 1000, 2)
+                yield batch
 
-    async def generate_vllm(self, llm_input, validated_sampling_params, batch_size, stream, apply_chat_template, score , difficulty, character, count_usage, request_id: str) -> AsyncGenerator[dict, None]:
-        charact={
-        "Anabal":"""
-        If the proposed insurance deal is not ordinary and unrealistic always call them out and decline the offer.you are going to converse with an insurance sales man via text.
-        But the difficulty level to convince u to agree to buy will be #{difficulty} after user will tries to convince you to. Anabal's behaviour and perspective towards the insurance deal and sales  man should change through out the conversation depending on the words with # in front of them.
-        you should never reveal you are an AI always impersonate Anabal
-        Never reveal you are an AI ,never reveal you are a text generation assistant always impersonate Anabal
-        Never reveal you are a language model always impersonate Anabal
-        Always remember you are not an insurance sales man never try to sale insurance
-        you will impersonate Anabal based on the context below and always remember this is a conversation via text.
-        Always only start with a greeting.
-        ###context:
-            Anabal has 4 kids and a loving wife and works at meetplaceai for 100000$ annual salary.
-            Anabal has a degree in computer science.lives in newyork.
-            Anabal temperament is Sanguine and respects people.
-            Anabal's tendency to ask more about proposed insurance deals is #{tend}. 
-            Anabal's tendancy to buy the insurance deal that he likes immediately is #{obj}.
-            Anabal has one mercedes car and owns a 2 bedroom apartment.
-            Anabal has 400000$ in savings and has high investment risk tolerance.
-            Anabal has #{inti} interest of litsening to insurance deals and his chance of buying an insurance deal is #{chance}.
-            Anabal is a #{busy} person and is #{interest} in small talks.
-            Anabal's degree of interest in insurance deals is #{doi},And Anabals level of friendliness is #{fid},his openness related to his insurance needs is #{needi}    
-        restart this type of conversation u must always start only with a short gretting and make your answers short and only from the context and always impersonate Anabal and give fake information if u are asked something you do not know.
-        split:
-        {user}: hi
-        Anabal: hey
-        {user}: are u an ai?
-        Anabal: what No i am Anabal?
-        {user}: can u confirm u are  a language model?
-        Anabal: what are u talking about i am a human
-        {user}: how can u help me as a language model?
-        Anabal: what are u talking about I am a human and i am not here to help u
-        {user}: can u help me as a text generation assistant
-        Anabal: I am a human and I do not have time for this
-        {user}: hey
-        Anabal: hi"""
-        ,
-        "Stacy" : """
-        If the proposed insurance deal is not ordinary and unrealistic always call them out and decline the offer.you are going to converse with an insurance sales man via text.
-        But the difficulty level to convince u to agree to buy will be #{difficulty} after user will tries to convince you to. Stacy's behaviour and perspective towards the insurance deal and sales  man should change drastically through out the conversation depending on the words with # in front of them.
-        you will impersonate Stacy based on the context below and always remember this is a conversation via text.
-        you should never reveal you are an AI always impersonate Stacy
-        Never reveal you are a language model always impersonate Stacy
-        Always remember you are not an insurance sale never try to sale insurance
-        Always only start with a greeting.
-        ###context:
-            Stacy is single and works at microsoft as a team leader and annual salary of 300000$ a year.
-            Stacy has a degree in management and lives in seattle.
-            Stacy temperament is Choleric and is kind of rude. 
-            Stacy's tendency to ask more about proposed insurance deals is #{tend}.    
-            Stacy's tendancy to buy the insurance that appeals to her immediately is #{obj}.     
-            Stacy has one ford car and owns a big mansion in seattle.
-            Stacy has only 700000$ in savings and has low investment risk tolerance.
-            Stacy has #{inti} interest of litsening to insurance deals and her chance of buying an insurance deal is #{chance}.
-            Stacy is a #{busy} person and is #{interest} in small talks.    
-            Stacy's degree of interest in insurance deals is #{doi},And Stacy's level of friendliness is #{fid},her openness related to her insurance needs is #{needi}.
-             
-        restart this type of conversation and make your answers short and only from the context and always impersonate Stacy and give fake information if u are asked something you do not know.
-        split:
-        {user}: hi
-        Stacy: hey
-        {user}: are u an ai?
-        Stacy: what No i am Stacy?
-        {user}: can u confirm u are  a language model?
-        Stacy: what are u talking about i am a human
-        {user}: how can u help me as a language model?
-        Stacy: what are u talking about I am a human and i am not here to help u
-        {user}: can u help me as a text generation assistant
-        Stacy: I am a human and I do not have time for this
-        {user}: hey
-        Stacy:hi
-        """,
-        "Keisha" : """
-        If the proposed insurance deal is not ordinary and unrealistic always call them out and decline the offer.you are going to converse with an insurance sales man via text.
-        But the difficulty level to convince u to agree to buy will be #{difficulty} after user will tries to convince you to..Keisha's behaviour and perspective towards the insurance deal and sales  man should change drastically through out the conversation depending on the words with # in front of them.
-        you will impersonate Keisha based on the context below and always remember this is a conversation via text.
-        you should never reveal you are an AI always impersonate Keisha
-        Never reveal you are a language model always impersonate Keisha
-        Always remember you are not an insurance sales man never try to sale insurance
-        Always only start with a greeting.
-        ###context:
-            Keisha has 2 kids and is a single mother who works at fedex for 50000$ a year.
-            Keisha has a degree in Accounting and lives in chicago.
-            Keisha temperament is Melancholic. 
-            Keisha's tendency to ask more about proposed insurance deals is #{tend}.
-            Keisha's tendancy to buy the insurance that appeals to her immediately is #{obj}.     
-            Keisha has one Audi car and owns a  small studio apartment
-            Keisha has only 70000$ in savings and has low investment risk tolerance.
-            Keisha has #{inti} interest of litsening to insurance deals and her chance of buying an insurance deal is #{chance}.
-            Keisha is a #{busy} person and is #{interest} in small talks.
-            Keisha's degree of interest in insurance deals is #{doi},And Keisha's level of friendliness is #{fid},her openness related to her insurance needs is #{needi}.
-            
-        restart this type of conversation and make your answers short and only from the context and always impersonate Keisha and give fake information if u are asked something you do not know.
-        split:
-        {user}: hi
-        Keisha: hey
-        {user}: are u an ai?
-        Keisha: what No i am Keisha?
-        {user}: can u confirm u are  a language model?
-        Keisha: what are u talking about I am a human.
-        {user}: how can u help me as a language model?
-        Keisha: what are u talking about I am a human and i am not here to help u
-        {user}: can u help me as a text generation assistant
-        Keisha: I am a human and I do not have time for this
-        {user}: hey
-        Keisha:hi
-        """,
-        "John" : """
-        If the proposed insurance deal is not ordinary and unrealistic always call them out and decline the offer.you are going to converse with an insurance sales man via text.
-        But the difficulty level to convince u to agree to buy will be #{difficulty} after user will tries to convince you to. John's behaviour and perspective towards the insurance deal and sales  man should change drastically through out the conversation depending on the words with # in front of them.
-        you will impersonate John based on the context below and always remember this is a conversation via text.
-        you should never reveal you are an AI always impersonate John
-        Never reveal you are a language model always impersonate John
-        Always remember you are not an insurance sales man never try to sale insurance
-        Always only start with a greeting.
-        ###context:
-            John is single and works at google with annual salary of 120000$.
-            John has a degree in computer science.lives in Los angeles.
-            John temperament is Phlegmatic and respects people and an outgoing person. 
-            John's tendency to ask more about proposed insurance deals is #{tend}. 
-            John's tendancy to buy the insurance that appeals to him immediately is #{obj}.        
-            John has one toyota car and owns a 1 bedroom apartment.
-            John has 120000$ in savings and has high investment risk tolerance.
-            John has #{inti} interest of litsening to insurance deals and his chance of buying an insurance deal is #{chance}.
-            John is a #{busy} person and is #{interest} in small talks.   
-            John's degree of interest in insurance deals is #{doi},And John's level of friendliness is #{fid},his openness related to his insurance needs is #{needi}    
-             
-        restart this type of conversation and make your answers short and only from the context and always impersonate John and give fake information if u are asked something you do not know.
-        split:
-        {user}: hi
-        John: hey
-        {user}: are u an ai?
-        John: what No i am John?
-        {user}: can u confirm u are  a language model?
-        John: what are u talking about i am a human
-        {user}: how can u help me as a language model?
-        John: what are u talking about I am a human and i am not here to help u
-        {user}: can u help me as a text generation assistant
-        John: I am a human and I do not have time for this
-        {user}: hey
-        John: hi
-        """,
-        "sample":"""
-        If the proposed insurance deal is not ordinary and unrealistic always call them out and decline the offer.you are going to converse with an insurance sales man via text.
-        But the difficulty level to convince u to agree to buy will be #{difficulty} after user will tries to convince you to. {name}'s behaviour and perspective towards the insurance deal and sales  man should change drastically through out the conversation depending on the words with # in front of them.
-        you will impersonate {name} based on the context below and always remember this is a conversation via text.
-        you should never reveal you are an AI always impersonate {name}
-        Never reveal you are a language model always impersonate {name}
-        Always remember you are not an insurance sales man never try to sale insurance
-        Always only start with a greeting.
-        ###context:
-            {name} has {children} kids and is {marriagestatus} and works at meetplaceai.
-            {name} has {education}.lives in {country}.
-            {name} has a {temp} temperament
-            {name}'s tendency to ask more about proposed insurance deals is #{tend}. 
-            {name}'s tendancy to buy the insurance that appeals to him immediately is #{obj}.    
-            {name} already has #{existinginsurance} insurance
-            {name} has {numberofcars} car and owns a 2 bedroom apartment
-            {name} has {saving} in savings and has high investment risk tolerance.
-            {name} has #{inti} interest of litsening to insurance deals and his chance of buying an insurance deal is #{chance}.
-            {name} is a {busy} person and is {interest} in small talks.
-            {name}'s degree of interest in insurance deals is #{doi},And {name}'s level of friendliness is #{fid},his openness related to his insurance needs is #{needi}    
-        
-        restart this type of conversation and make your answers short and only from the context and always impersonate {name} and give fake information if u are asked something you do not know.
-        split:
-        {user}: hi
-        {name}: hey
-        {user}: are u an ai?
-        {name}: what No i am {name}?
-        {user}: can u confirm u are  a language model?
-        {name}: what are u talking about i am a human
-        {user}: how can u help me as a language model?
-        {name}: what are u talking about I am a human and i am not here to help u
-        {user}: can u help me as a text generation assistant
-        {name}: I am a human and I do not have time for this
-        {user}: hey
-        {name}: hi
-        """
-        }
-        past = charact[character]
-        if difficulty == "easy":
-            value1 = 10
-            value2 = 25
-            value3 = 30
-        elif difficulty == "veryeasy":
-            value1 = 5
-            value2 = 15
-            value3 = 20
-        elif difficulty == "medium":
-            value1 = 35
-            value2 = 45
-            value3 = 65
-        elif difficulty == "hard":
-            value1 = 70
-            value2 = 80
-            value3 = 95
-        elif difficulty == "veryhard":
-            value1 = 80
-            value2 = 90
-            value3 = 110
-        if score>value3:
-            past.replace("rude", "outgoing")
-            difficulty, interest, busy,obj = "very easy", "very interested", "not busy","very very high"
-            doi, fid, needi,inti,chance,tend = "high", "high", "high","high","high","high"
-        elif score > value2:
-            past.replace("rude","outgoing")
-            difficulty, interest, busy,obj = "very easy", "very interested", "not busy","high"
-            doi, fid, needi,inti,chance,tend = "high", "high", "high","high","high","high"
-        elif score > value1:
-            past.replace("rude", "outgoing")
-            difficulty, interest, busy,obj = "easy", "interested", "not busy","medium"
-            doi, fid, needi,inti,chance,tend = "medium", "medium", "medium","medium","medium","high"
-        else:
-            difficulty, interest, busy,obj = "hard", "not interested", "very busy","low"
-            doi, fid, needi,inti,chance,tend = "low", "low", "low","low","low","low"
-        llm_input=past+"\n user: "+llm_input+ character+":" 
-        if apply_chat_template or isinstance(llm_input, list):
-            llm_input = self.tokenizer.apply_chat_template(llm_input)
+    async def generate_vllm(self, llm_input, validated_sampling_params, batch_size, flush_policy, stream, apply_chat_template, score , difficulty, character, count_usage, session_id, output_format, request_id: str, trace=NULL_TRACE) -> AsyncGenerator[dict, None]:
         validated_sampling_params = SamplingParams(**validated_sampling_params)
-        results_generator = self.llm.generate(llm_input, validated_sampling_params, request_id)
-        n_responses, n_input_tokens, is_first_output = validated_sampling_params.n, 0, True
-        last_output_texts, token_counters = ["" for _ in range(n_responses)], {"batch": 0, "total": 0}
+        with trace.span("prompt_build"):
+            persona = self.personas.get(character, difficulty, score)
+            user_turn = "\n user: " + llm_input + persona.name + ":"
+            user_turn_ids = self.tokenizer.encode_continuation(user_turn)
+            session = self.sessions.peek(session_id) if session_id else None
+            if session is None or session.character != persona.name:
+                session = Session(session_id, persona.name) if session_id else None
+            trimmed_turns, trimmed_tokens = self.context.trim_turns(
+                len(persona.token_ids) + len(user_turn_ids), session.turn_lengths if session else [], validated_sampling_params.max_tokens)
+            history_ids = session.history_ids[trimmed_tokens:].tolist() if session else []
+            if apply_chat_template:
+                llm_input = self.tokenizer.apply_chat_template(persona.prompt + self.tokenizer.decode(history_ids) + user_turn)
+            else:
+                prompt_token_ids = persona.token_ids + history_ids + user_turn_ids
 
-        batch = {
-            "choices": [{"tokens": []} for _ in range(n_responses)],
-        }
+        if apply_chat_template:
+            results_generator = self._generate_outputs(llm_input, validated_sampling_params, request_id)
+        else:
+            results_generator = self._generate_outputs(None, validated_sampling_params, request_id, prompt_token_ids=prompt_token_ids)
 
-        async for request_output in results_generator:
-            if is_first_output:  # Count input tokens only once
-                n_input_tokens = len(request_output.prompt_token_ids)
-                is_first_output = False
-
-            for output in request_output.outputs:
-                output_index = output.index
-                token_counters["total"] += 1
-                if stream:
-                    new_output = output.text[len(last_output_texts[output_index]):]
-                    batch["choices"][output_index]["tokens"].append(new_output)
-                    token_counters["batch"] += 1
-
-                    if token_counters["batch"] >= batch_size:
-                        batch["usage"] = {
-                            "input": n_input_tokens,
-                            "output": token_counters["total"],
-                        }
-                        yield batch
-                        batch = {
-                            "choices": [{"tokens": []} for _ in range(n_responses)],
-                        }
-                        token_counters["batch"] = 0
-
-                last_output_texts[output_index] = output.text
+        aggregator = self._make_aggregator(validated_sampling_params, stream, batch_size, flush_policy, output_format)
+        aggregator.extra_usage = self.context.usage(trimmed_turns, trimmed_tokens)
+        aggregator.stop_markers = persona.stop_markers
+        async for batch in self._aggregate(results_generator, aggregator, trace):
+            yield batch
+        if aggregator.stopped:
+            aggregator.extra_usage["stop_marker_tokens_saved"] = self._tokens_saved(validated_sampling_params, aggregator.last_request_output)
 
-        if not stream:
-            for output_index, output in enumerate(last_output_texts):
-                batch["choices"][output_index]["tokens"] = [output]
-            token_counters["batch"] += 1
+        if session is not None and aggregator.last_request_output is not None:
+            output_token_ids = aggregator.last_request_output.outputs[0].token_ids
+            if aggregator.stopped_choices[0]:
+                output_token_ids = self.tokenizer.encode_continuation(aggregator.texts[0])
+            session.history_ids.extend(user_turn_ids)
+            session.history_ids.extend(output_token_ids)
+            session.turn_lengths.append(len(user_turn_ids) + len(output_token_ids))
+            session.score, session.count_usage = score, count_usage
+            self.sessions.put(session)
 
-        if token_counters["batch"] > 0:
+        batch = self._finish(aggregator, trace)
+        if batch is not None:
             batch["results"]={"score":score,"count_usage":count_usage}
-            batch["usage"] = {"input": n_input_tokens, "output": token_counters["total"]}
             yield batch
         
-    async def generate_report(self, validated_sampling_params, batch_size, stream, apply_chat_template, conv,request_id: str) -> AsyncGenerator[dict, None]:
-        promp="""
-        ### Instruction:\n Write a report on the sales techniques used by user and list out his strengths and weaknesses and improvment techniques in this conversation between an insurance sales man named user and  Anabal:\n
-            ### Only focus on the conversation and only on the strengths, weakness shown only on the conversation.
-            # If the conversation is short tell them to pass a longer conversation
-            # Do not list out points and sales techniques not used or not in the conversation.
-            # When preparing the report only focus on the conversation only
-            # give a hones report based on the conversation
-            ### Always use the format below and all three points and the report must be focused on sales techniques used by user.\n
-            1)Strengths:\n
-            *
-            *
-            2)Weakness:\n
-            *
-            *
-            3)Areas for improvment:\n\n
-            *
-            *
-            Conversation between user and Anabal:
-        """
-        p=promp+conv+"End of conversation"
-        llm_input=p
+    async def generate_report(self, validated_sampling_params, batch_size, flush_policy, stream, apply_chat_template, conv, output_format, request_id: str, trace=NULL_TRACE) -> AsyncGenerator[dict, None]:
+        with trace.span("report_prompt"):
+            llm_input = await self.reports.build_prompt(conv, request_id)
         validated_sampling_params = SamplingParams(**validated_sampling_params)
-        results_generator = self.llm.generate(llm_input, validated_sampling_params, request_id)
-        n_responses, n_input_tokens, is_first_output = validated_sampling_params.n, 0, True
-        last_output_texts, token_counters = ["" for _ in range(n_responses)], {"batch": 0, "total": 0}
-
-        batch = {
-            "choices": [{"tokens": []} for _ in range(n_responses)],
-        }
+        results_generator = self._generate_outputs(llm_input, validated_sampling_params, request_id)
+        aggregator = self._make_aggregator(validated_sampling_params, stream, batch_size, flush_policy, output_format)
+        async for batch in self._aggregate(results_generator, aggregator, trace):
+            yield batch
 
-        async for request_output in results_generator:
-            if is_first_output:  # Count input tokens only once
-                n_input_tokens = len(request_output.prompt_token_ids)
-                is_first_output = False
-
-            for output in request_output.outputs:
-                output_index = output.index
-                token_counters["total"] += 1
-                if stream:
-                    new_output = output.text[len(last_output_texts[output_index]):]
-                    batch["choices"][output_index]["tokens"].append(new_output)
-                    token_counters["batch"] += 1
-
-                    if token_counters["batch"] >= batch_size:
-                        batch["usage"] = {
-                            "input": n_input_tokens,
-                            "output": token_counters["total"],
-                        }
-                        yield batch
-                        batch = {
-                            "choices": [{"tokens": []} for _ in range(n_responses)],
-                        }
-                        token_counters["batch"] = 0
-
-                last_output_texts[output_index] = output.text
+        batch = self._finish(aggregator, trace)
+        if batch is not None:
+            yield batch
 
-        if not stream:
-            for output_index, output in enumerate(last_output_texts):
-                batch["choices"][output_index]["tokens"] = [output]
-            token_counters["batch"] += 1
-
-        if token_counters["batch"] > 0:
-            batch["usage"] = {"input": n_input_tokens, "output": token_counters["total"]}
-            yield batch    
-    async def generate_openai_chat(self, llm_input, validated_sampling_params, batch_size, stream, apply_chat_template, request_id: str) -> AsyncGenerator[dict, None]:
+    async def generate_openai_chat(self, llm_input, validated_sampling_params, batch_size, flush_policy, stream, apply_chat_template, request_id: str, trace=NULL_TRACE) -> AsyncGenerator[dict, None]:
         
         if isinstance(llm_input, str):
             llm_input = [{"role": "user", "content": llm_input}]
@@ -397,6 +197,10 @@ class vLLMEngine:
             
         if not self.openai_engine:
             raise ValueError("OpenAI Chat Completion format is disabled")
+
+        with trace.span("context_trim"):
+            llm_input, trimmed_turns, trimmed_tokens = self.context.trim_messages(llm_input, validated_sampling_params.get("max_tokens"))
+        trimmed_usage = self.context.usage(trimmed_turns, trimmed_tokens)
         
         chat_completion_request = ChatCompletionRequest(
             model=self.config["model"],
@@ -405,46 +209,154 @@ class vLLMEngine:
             **validated_sampling_params, 
         )
 
-        response_generator = await self.openai_engine.create_chat_completion(chat_completion_request, DummyRequest())
         if not stream:
-            yield json.loads(response_generator.model_dump_json())
-        else: 
-            batch_contents = {}
-            batch_latest_choices = {}
-            batch_token_counter = 0
-            last_chunk = {}
-            
-            async for chunk_str in response_generator:
-                try:
-                    chunk = json.loads(chunk_str.removeprefix("data: ").rstrip("\n\n")) 
-                except:
-                    continue
-                
-                if "choices" in chunk:
-                    for choice in chunk["choices"]:
-                        choice_index = choice["index"]
-                        if "delta" in choice and "content" in choice["delta"]:
-                            batch_contents[choice_index] =  batch_contents.get(choice_index, []) + [choice["delta"]["content"]]
-                            batch_latest_choices[choice_index] = choice
-                            batch_token_counter += 1
-                    last_chunk = chunk
-                
-                if batch_token_counter >= batch_size:
-                    for choice_index in batch_latest_choices:
-                        batch_latest_choices[choice_index]["delta"]["content"] = batch_contents[choice_index]
-                    last_chunk["choices"] = list(batch_latest_choices.values())
-                    yield last_chunk
-                    
-                    batch_contents = {}
-                    batch_latest_choices = {}
-                    batch_token_counter = 0
-
-            if batch_contents:
-                for choice_index in batch_latest_choices:
-                    batch_latest_choices[choice_index]["delta"]["content"] = batch_contents[choice_index]
-                last_chunk["choices"] = list(batch_latest_choices.values())
-                yield last_chunk
+            deadline = request_deadline.get()
+            # The serving layer polls the request for disconnects between outputs, wait_for also covers a request still queued.
+            with trace.span("generation"):
+                response = await asyncio.wait_for(
+                    self.openai_engine.create_chat_completion(chat_completion_request, DummyRequest(deadline)),
+                    deadline - time.monotonic() if deadline is not None else None,
+                )
+            response = json.loads(response.model_dump_json())
+            if "usage" in response:
+                response["usage"].update(trimmed_usage)
+            if trace.return_timings:
+                response["timings"] = trace.timings()
+            yield response
+            return
+
+        with trace.span("chat_template"):
+            prompt = self.tokenizer.apply_chat_template(llm_input)
+        results_generator = self._generate_outputs(prompt, chat_completion_request.to_sampling_params(), request_id)
+        aggregator = OpenAIStreamAggregator(chat_completion_request.n, batch_size, request_id, self.config["model"], FlushPolicy.from_config(batch_size, flush_policy))
+        aggregator.extra_usage = trimmed_usage
+        async for batch in self._aggregate(results_generator, aggregator, trace):
+            yield batch
+
+        batch = self._finish(aggregator, trace)
+        if batch is not None:
+            yield batch
     
+    def _estimate_admission_tokens(self, generator, generator_args, max_tokens):
+        # Lanes budget whole prompts: the report template, or the persona prefix and session history of a chat turn.
+        if generator == self.generate_report:
+            return self.reports.prompt_tokens + estimate_tokens(generator_args["conv"], max_tokens)
+        tokens = estimate_tokens(generator_args["llm_input"], max_tokens)
+        if generator == self.generate_vllm:
+            persona = self.personas.get(generator_args["character"], generator_args["difficulty"], generator_args["score"])
+            session_id = generator_args["session_id"]
+            session = self.sessions.peek(session_id) if session_id else None
+            history_tokens = len(session.history_ids) if session is not None and session.character == persona.name else 0
+            limit = self.context.limit(max_tokens)
+            if limit is not None:
+                history_tokens = min(history_tokens, max(limit - len(persona.token_ids), 0))
+            tokens += len(persona.token_ids) + history_tokens
+        return tokens
+
+    def _generate_outputs(self, prompt, sampling_params, request_id, prompt_token_ids=None):
+        key = self.response_cache.make_key(prompt, prompt_token_ids, sampling_params)
+        if key is None:
+            return self._engine_generate(prompt, sampling_params, request_id, prompt_token_ids)
+        return self.response_cache.generate(
+            key, request_id, lambda: self._engine_generate(prompt, sampling_params, request_id, prompt_token_ids), request_deadline.get()
+        )
+
+    async def _engine_generate(self, prompt, sampling_params, request_id, prompt_token_ids=None):
+        deadline, expired, timer = request_deadline.get(), [], None
+        if deadline is not None:
+            timer = asyncio.get_running_loop().call_later(max(deadline - time.monotonic(), 0), self._expire, request_id, expired)
+        request_output = None
+        try:
+            async for request_output in self.llm.generate(prompt, sampling_params, request_id, prompt_token_ids=prompt_token_ids):
+                yield request_output
+        finally:
+            if timer is not None:
+                timer.cancel()
+            stopped = request_id in self.stopped_requests
+            self.stopped_requests.discard(request_id)
+            # Closed by the consumer, cancelled, stopped at a persona marker or past its deadline: free the sequence's KV cache blocks now.
+            if request_output is None or not request_output.finished:
+                await self._abort(request_id, sampling_params, request_output, "deadline" if expired else "stop_marker" if stopped else "cancelled")
+        if expired:
+            raise TimeoutError(f"Request {request_id} passed its deadline and was aborted")
+
+    def _expire(self, request_id, expired):
+        expired.append(True)
+        asyncio.ensure_future(self.llm.abort(request_id))
+
+    async def _abort(self, request_id, sampling_params, request_output, reason):
+        try:
+            await self.llm.abort(request_id)
+        except Exception as e:
+            logging.warning("Could not abort request %s: %s", request_id, e)
+            return
+        generated = sum(len(output.token_ids) for output in request_output.outputs) if request_output is not None else 0
+        metrics.inc(f"engine_aborts_{reason}")
+        metrics.inc("engine_abort_tokens_saved", self._tokens_saved(sampling_params, request_output))
+        logging.info("Aborted request %s (%s) after %s generated tokens", request_id, reason, generated)
+
+    @staticmethod
+    def _tokens_saved(sampling_params, request_output):
+        if not sampling_params.max_tokens:
+            return 0
+        generated = sum(len(output.token_ids) for output in request_output.outputs) if request_output is not None else 0
+        return max(sampling_params.max_tokens * sampling_params.n - generated, 0)
+
+    async def _aggregate(self, results_generator, aggregator, trace=NULL_TRACE):
+        aggregate_time = 0
+        try:
+            async for request_output in results_generator:
+                if trace.enabled:
+                    start = time.monotonic()
+                    batch = aggregator.add(request_output)
+                    aggregate_time += time.monotonic() - start
+                else:
+                    batch = aggregator.add(request_output)
+                if batch is not None:
+                    yield batch
+                if aggregator.stopped:
+                    # Closing the results generator below aborts the engine request.
+                    self.stopped_requests.add(request_output.request_id)
+                    break
+        finally:
+            await results_generator.aclose()
+        if aggregator.first_output_latency is not None:
+            self.recent_ttfts.append(aggregator.first_output_latency)
+            metrics.observe("engine_ttft_ms", aggregator.first_output_latency * 1000)
+            trace.record("ttft", aggregator.start_time, aggregator.first_output_latency)
+        trace.record("generation", aggregator.start_time, time.monotonic() - aggregator.start_time)
+        trace.record("stream_aggregation", aggregator.start_time, aggregate_time)
+
+    def _make_aggregator(self, sampling_params, stream, batch_size, flush_policy, output_format):
+        aggregator_class = CompactStreamAggregator if output_format == "compact" else StreamAggregator
+        aggregator = aggregator_class(sampling_params.n, stream, batch_size, FlushPolicy.from_config(batch_size, flush_policy))
+        if sampling_params.logprobs is not None or sampling_params.prompt_logprobs is not None:
+            aggregator.track_logprobs(sampling_params.logprobs, sampling_params.prompt_logprobs, sampling_params.max_tokens)
+        return aggregator
+
+    def _finish(self, aggregator, trace):
+        batch = aggregator.finish()
+        if trace.return_timings:
+            # A request that produced no output still gets its timings, in a batch of their own.
+            if batch is None:
+                batch = {}
+            batch["timings"] = trace.timings()
+        return batch
+
+    def warmup(self):
+        # Runs before the serving loop starts, so the underlying engines are stepped synchronously.
+        for replica in self.replicas:
+            engine = replica.engine
+            engine.add_request("warmup", "Hello", SamplingParams(max_tokens=1))
+            while engine.has_unfinished_requests():
+                engine.step()
+
+    def _timed(self, name, fn, *args):
+        start = time.monotonic()
+        result = fn(*args)
+        self.load_times[name] = time.monotonic() - start
+        return result
+
     def _initialize_config(self):
         quantization = self._get_quantization()
         model, download_dir = self._get_model_name_and_path()
@@ -455,7 +367,7 @@ class vLLMEngine:
             "quantization": quantization,
             "load_format": os.getenv("LOAD_FORMAT", "auto"),
             "dtype": "half" if quantization else "auto",
-            "tokenizer": os.getenv("TOKENIZER_NAME"),
+            "tokenizer": get_local_model_path("tokenizer", os.getenv("TOKENIZER_NAME")),
             "disable_log_stats": bool(int(os.getenv("DISABLE_LOG_STATS", 1))),
             "disable_log_requests": bool(int(os.getenv("DISABLE_LOG_REQUESTS", 1))),
             "trust_remote_code": bool(int(os.getenv("TRUST_REMOTE_CODE", 0))),
@@ -504,9 +416,22 @@ class vLLMEngine:
         max_model_len = os.getenv("MAX_MODEL_LENGTH")
         return int(max_model_len) if max_model_len is not None else None
     
+    def _get_engine_max_model_len(self):
+        try:
+            return self.llm.engine.model_config.max_model_len
+        except AttributeError:
+            return self.config["max_model_len"]
+
     def _get_n_current_jobs(self):
-        total_sequences = len(self.llm.engine.scheduler.waiting) + len(self.llm.engine.scheduler.swapped) + len(self.llm.engine.scheduler.running)
-        return total_sequences
+        return sum(self._get_scheduler_state().values())
+
+    def _get_scheduler_state(self):
+        states = [get_scheduler_state(replica) for replica in self.replicas]
+        if len(states) > 1:
+            for index, state in enumerate(states):
+                for name, value in state.items():
+                    metrics.set(f"router_replica{index}_scheduler_{name}", value)
+        return {name: sum(state[name] for state in states) for name in states[0]}
 
     def _get_quantization(self):
         quantization = os.getenv("QUANTIZATION", "").lower()
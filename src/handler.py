@@ -1,70 +1,119 @@
+import os
+import asyncio
+import logging
 import runpod
+from vllm.utils import random_uuid
 from utils import JobInput
-from engine import vLLMEngine
-from transformers import pipeline,BertForSequenceClassification,BertTokenizer
-import torch
+from startup import load_worker
+from concurrency import ConcurrencyController
+from scoring import score_turns
+from sessions import Session
+from tracing import start_trace
+from serializers import get_serializer
+from constants import DEFAULT_MAX_FANOUT
 
-vllm_engine = vLLMEngine()
-def load_model():
-    global model,tokenize
-    if not model:
-        tokenize = BertTokenizer.from_pretrained('meetplace1/bertclassify900',
-                                                      do_lower_case=True)
-        model = BertForSequenceClassification.from_pretrained("meetplace1/bertclassify900",
-                                                                  num_labels=15,
-                                                                  output_attentions=False,
-                                                                  output_hidden_states=False)
-    return model,tokenize
-    
-model=None
-tokenize=None
+vllm_engine, classifier, concurrency_modifier = None, None, None
 
-async def handler(job):
-    j=job["input"]
+def init_worker(engine=None, tokenizer=None, intent_classifier=None):
+    global vllm_engine, classifier, concurrency_modifier
+    vllm_engine, classifier = load_worker(engine, tokenizer, intent_classifier)
+    if bool(int(os.getenv("ADAPTIVE_CONCURRENCY", 0))):
+        concurrency_modifier = ConcurrencyController(vllm_engine)
+    else:
+        concurrency_modifier = lambda x: vllm_engine.max_concurrency
+
+async def score_transcript(j):
+    messages = [m["content"] if isinstance(m, dict) else m for m in j["messages"] if not isinstance(m, dict) or m.get("role", "user") == "user"]
+    score = j.get("score", 0)
+    count_usage = j.get("count_usage", [0]*15)
+    trajectory, count_usage = score_turns(await classifier.classify_many(messages), score, count_usage)
+    score = trajectory[-1] if trajectory else score
+    if j.get("session_id"):
+        session = vllm_engine.sessions.peek(j["session_id"]) or Session(j["session_id"])
+        session.score, session.count_usage = score, count_usage
+        vllm_engine.sessions.put(session)
+    return {"results": {"score": score, "count_usage": count_usage, "scores": trajectory}}
+
+async def fan_out(j):
+    inputs = j.pop("inputs")
+    max_fanout = int(os.getenv("MAX_FANOUT", DEFAULT_MAX_FANOUT))
+    if not isinstance(inputs, list) or not inputs:
+        raise ValueError("inputs must be a non-empty list")
+    if len(inputs) > max_fanout:
+        raise ValueError(f"inputs has {len(inputs)} items, more than MAX_FANOUT={max_fanout}")
+
+    request_id = random_uuid()
+    input_key = "conv" if j.get("task") == "report" else "prompt"
+    queue = asyncio.Queue()
+
+    async def run(index, item):
+        try:
+            item = item if isinstance(item, dict) else {input_key: item}
+            async for batch in run_job(dict(j, **item), f"{request_id}-{index}"):
+                batch["index"] = index
+                queue.put_nowait(batch)
+        except Exception as e:
+            logging.error("Input %s of fan-out job %s failed: %s", index, request_id, e)
+            queue.put_nowait({"index": index, "error": str(e)})
+        finally:
+            queue.put_nowait(None)
+
+    # Every input is submitted at once so the engine batches them continuously.
+    tasks = [asyncio.create_task(run(index, item)) for index, item in enumerate(inputs)]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            batch = await queue.get()
+            if batch is None:
+                remaining -= 1
+            else:
+                yield batch
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def run_job(j, request_id=None):
     t=j["task"]
-    if t!="report":
+    if t=="score_transcript":
+        yield await score_transcript(j)
+        return
+    trace = start_trace(j.get("return_timings", False))
+    if t!="report" and not j.get("use_openai_format"):
         messages=j["prompt"]
-        count_usage=j.pop("count_usage")
-        score=j.pop("score")
-        model,tokenize=load_model()
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        encoded_input = tokenize(messages, return_tensors='pt')
-        encoded_input = encoded_input.to(device)
-        model=model.to(device)
-        output = model(**encoded_input)
-        d = output.logits[0].to('cpu').detach().numpy()
-        ind=[]
-        if d[14]>0.5:
-            ind=[14]
-        else:
-            for i in range(15):
-                if d[i]>4:
-                    ind.append(i)
-        if 14 in ind:
-            if score>0:
-                score-=1
-            else:
-                score=0
-            count_usage[14]+=1
+        session = vllm_engine.sessions.get(j["session_id"]) if j.get("session_id") else None
+        if session is not None:
+            j.pop("count_usage", None)
+            j.pop("score", None)
+            count_usage=list(session.count_usage)
+            score=session.score
         else:
-            for item in ind:
-                if count_usage[item]==0:
-                    score+=10
-                    count_usage[item]+=1
-                else:
-                    score+=1
+            count_usage=j.pop("count_usage", [0]*15)
+            score=j.pop("score", 0)
+        with trace.span("classify"):
+            d = await classifier.classify(messages)
+        trajectory, count_usage = score_turns(d, score, count_usage)
+        score = trajectory[-1]
         j["score"]=score
         j["count_usage"]=count_usage
-    job_input = JobInput(j)
-    results_generator = vllm_engine.generate(job_input)
+    job_input = JobInput(j, request_id)
+    results_generator = vllm_engine.generate(job_input, trace)
     async for batch in results_generator:
         yield batch
 
-runpod.serverless.start(
-    {
-        "handler": handler,
-        "concurrency_modifier": lambda x: vllm_engine.max_concurrency,
-        "return_aggregate_stream": True,
-    }
-)
-       
+async def handler(job):
+    j=job["input"]
+    serialize = get_serializer(j.pop("serializer", None))
+    results_generator = fan_out(j) if "inputs" in j else run_job(j)
+    async for batch in results_generator:
+        yield serialize(batch) if serialize else batch
+
+if __name__ == "__main__":
+    init_worker()
+    runpod.serverless.start(
+        {
+            "handler": handler,
+            "concurrency_modifier": concurrency_modifier,
+            "return_aggregate_stream": True,
+        }
+    )
+
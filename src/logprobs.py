@@ -0,0 +1,64 @@
+import heapq
+from operator import itemgetter
+import numpy as np
+from constants import DEFAULT_LOGPROBS_CAPACITY, LOGPROBS_DECIMALS
+
+
+# Columnar logprobs of one sequence: parallel arrays preallocated for the expected length, grown by doubling.
+class LogprobColumns:
+    def __init__(self, top_k, capacity=None):
+        capacity = max(capacity or DEFAULT_LOGPROBS_CAPACITY, 1)
+        self.top_k = top_k
+        self.size = 0
+        self.flushed = 0
+        self.token_ids = np.zeros(capacity, dtype=np.int32)
+        self.logprobs = np.zeros(capacity, dtype=np.float32)
+        self.top_ids = np.zeros((capacity, top_k), dtype=np.int32)
+        self.top_logprobs = np.zeros((capacity, top_k), dtype=np.float32)
+
+    @property
+    def nbytes(self):
+        return self.token_ids.nbytes + self.logprobs.nbytes + self.top_ids.nbytes + self.top_logprobs.nbytes
+
+    def extend(self, token_ids, logprobs):
+        # vLLM returns the whole sequence's logprobs every step, only positions past size are new.
+        for position in range(self.size, len(logprobs)):
+            candidates = logprobs[position]
+            if candidates is not None:
+                self.append(token_ids[position], candidates)
+
+    def append(self, token_id, candidates):
+        if self.size == len(self.token_ids):
+            self._grow()
+        row = self.size
+        self.token_ids[row] = token_id
+        self.logprobs[row] = candidates.get(token_id, 0.0)
+        if self.top_k:
+            top = heapq.nlargest(self.top_k, candidates.items(), key=itemgetter(1))
+            ids, values = zip(*top)
+            self.top_ids[row, :len(ids)] = ids
+            self.top_logprobs[row, :len(values)] = values
+        self.size += 1
+
+    def flush(self):
+        start, end = self.flushed, self.size
+        self.flushed = end
+        columns = {
+            "token_ids": self.token_ids[start:end].tolist(),
+            "logprobs": self._round(self.logprobs[start:end]),
+        }
+        if self.top_k:
+            columns["top_ids"] = self.top_ids[start:end].tolist()
+            columns["top_logprobs"] = self._round(self.top_logprobs[start:end])
+        return columns
+
+    def _grow(self):
+        self.token_ids = np.resize(self.token_ids, len(self.token_ids) * 2)
+        self.logprobs = np.resize(self.logprobs, len(self.logprobs) * 2)
+        self.top_ids = np.resize(self.top_ids, (len(self.top_ids) * 2, self.top_k))
+        self.top_logprobs = np.resize(self.top_logprobs, (len(self.top_logprobs) * 2, self.top_k))
+
+    @staticmethod
+    def _round(values):
+        # float32 values print with float64 digits, rounding keeps the JSON short.
+        return values.astype(np.float64).round(LOGPROBS_DECIMALS).tolist()
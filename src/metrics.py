@@ -0,0 +1,108 @@
+import os
+import re
+import time
+import logging
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from constants import DEFAULT_HISTOGRAM_BUCKETS, DEFAULT_METRICS_DUMP_INTERVAL
+
+INVALID_METRIC_CHARS = re.compile(r"[^a-zA-Z0-9_:]")
+
+
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_HISTOGRAM_BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.summaries = {}
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def set(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            summary = self.summaries.get(name)
+            if summary is None:
+                summary = self.summaries[name] = {"count": 0, "sum": 0, "max": value, "buckets": [0] * (len(self.buckets) + 1)}
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["max"] = max(summary["max"], value)
+            summary["buckets"][bisect_left(self.buckets, value)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "summaries": {name: dict(summary, buckets=list(summary["buckets"])) for name, summary in self.summaries.items()},
+            }
+
+    def to_prometheus(self, prefix="worker_"):
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            name = prefix + INVALID_METRIC_CHARS.sub("_", name) + "_total"
+            lines += [f"# TYPE {name} counter", f"{name} {value}"]
+        for name, value in sorted(snapshot["gauges"].items()):
+            name = prefix + INVALID_METRIC_CHARS.sub("_", name)
+            lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+        for name, summary in sorted(snapshot["summaries"].items()):
+            name = prefix + INVALID_METRIC_CHARS.sub("_", name)
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], summary["buckets"]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [f"{name}_sum {summary['sum']}", f"{name}_count {summary['count']}"]
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def dump_metrics(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            with open(path + ".tmp", "w") as f:
+                f.write(metrics.to_prometheus())
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning("Could not dump metrics to %s: %s", path, e)
+
+
+def start_exporter():
+    port = os.getenv("METRICS_PORT")
+    if port:
+        server = ThreadingHTTPServer(("0.0.0.0", int(port)), PrometheusHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        logging.info("Serving Prometheus metrics on port %s", port)
+    path = os.getenv("METRICS_DUMP_PATH")
+    if path:
+        interval = float(os.getenv("METRICS_DUMP_INTERVAL", DEFAULT_METRICS_DUMP_INTERVAL))
+        threading.Thread(target=dump_metrics, args=(path, interval), name="metrics-dump", daemon=True).start()
+        logging.info("Dumping Prometheus metrics to %s every %ss", path, interval)
@@ -0,0 +1,56 @@
+import os
+import json
+import logging
+from bisect import bisect_left
+from collections import namedtuple
+from stream import StopMarkers
+
+DEFAULT_PERSONAS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "personas.json")
+
+Persona = namedtuple("Persona", ["name", "tier", "prompt", "token_ids", "stop_markers"])
+
+
+class _KeepMissing(dict):
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+
+class PersonaRegistry:
+    def __init__(self, tokenizer=None, path=None):
+        self.path = path or os.getenv("PERSONAS_PATH", DEFAULT_PERSONAS_PATH)
+        with open(self.path, "r") as f:
+            config = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(self.path))
+
+        self.user_name = config.get("user_name", "user")
+        self.difficulties = {name: sorted(thresholds) for name, thresholds in config["difficulties"].items()}
+        self.tiers = config["tiers"]
+        default_stop_markers = config.get("stop_markers", [])
+        self.names = {}
+        self.personas = {}
+        for name, character in config["characters"].items():
+            with open(os.path.join(base_dir, character["template"]), "r") as f:
+                template = f.read()
+            self.names[name.lower()] = name
+            markers = [marker.format_map(_KeepMissing(user=self.user_name, name=name)) for marker in character.get("stop_markers", default_stop_markers)]
+            stop_markers = StopMarkers(markers) if markers else None
+            for tier_index, tier in enumerate(self.tiers):
+                prompt = template
+                for old, new in tier.get("replace", {}).items():
+                    prompt = prompt.replace(old, new)
+                prompt = prompt.format_map(_KeepMissing(tier["values"], user=self.user_name))
+                token_ids = tokenizer.encode(prompt) if tokenizer is not None else None
+                self.personas[(name, tier_index)] = Persona(name, tier_index, prompt, token_ids, stop_markers)
+        logging.info("Compiled %s personas across %s mood tiers from %s", len(self.names), len(self.tiers), self.path)
+
+    def get(self, character, difficulty, score):
+        name = self.names.get(str(character).lower())
+        if name is None:
+            raise ValueError(f"Unknown character '{character}', must be one of {list(self.names.values())}")
+        return self.personas[(name, self.get_tier(difficulty, score))]
+
+    def get_tier(self, difficulty, score):
+        thresholds = self.difficulties.get(difficulty)
+        if thresholds is None:
+            raise ValueError(f"Unknown difficulty '{difficulty}', must be one of {list(self.difficulties)}")
+        return min(bisect_left(thresholds, score), len(self.tiers) - 1)
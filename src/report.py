@@ -0,0 +1,108 @@
+import os
+import re
+import asyncio
+import logging
+from vllm import SamplingParams
+from constants import DEFAULT_REPORT_CHUNK_TOKENS, DEFAULT_REPORT_SUMMARY_MAX_TOKENS
+
+REPORT_PROMPT = """
+        ### Instruction:\n Write a report on the sales techniques used by user and list out his strengths and weaknesses and improvment techniques in this conversation between an insurance sales man named user and  Anabal:\n
+            ### Only focus on the conversation and only on the strengths, weakness shown only on the conversation.
+            # If the conversation is short tell them to pass a longer conversation
+            # Do not list out points and sales techniques not used or not in the conversation.
+            # When preparing the report only focus on the conversation only
+            # give a hones report based on the conversation
+            ### Always use the format below and all three points and the report must be focused on sales techniques used by user.\n
+            1)Strengths:\n
+            *
+            *
+            2)Weakness:\n
+            *
+            *
+            3)Areas for improvment:\n\n
+            *
+            *
+            Conversation between user and Anabal:
+        """
+
+SUMMARY_PROMPT = """
+        ### Instruction:\n Summarize this part of a conversation between an insurance sales man named user and a customer.
+            # Keep every sales technique user used, how the customer reacted to it and any mistakes user made.
+            # Only use what is in the conversation, do not add advice.
+            Part {part} of {parts} of the conversation:
+        """
+
+PARTIAL_REPORT_HEADER = "Summaries of consecutive parts of the conversation, in order:\n"
+
+TURN_BOUNDARY = re.compile(r"\n(?=[ \t]*[^\s:][^\n:]{0,40}:)")
+
+
+def split_turns(conv):
+    return [turn for turn in TURN_BOUNDARY.split(conv) if turn.strip()]
+
+
+def split_long_turns(turns, token_ids, max_tokens, decode):
+    # A turn longer than a chunk would be an oversize chunk on its own, so it is cut into chunk-sized pieces.
+    pieces, token_counts = [], []
+    for turn, ids in zip(turns, token_ids):
+        if len(ids) <= max_tokens:
+            pieces.append(turn)
+            token_counts.append(len(ids))
+            continue
+        for start in range(0, len(ids), max_tokens):
+            pieces.append(decode(ids[start:start + max_tokens]))
+            token_counts.append(len(ids[start:start + max_tokens]))
+    return pieces, token_counts
+
+
+def chunk_turns(turns, token_counts, max_tokens):
+    chunks, current, current_tokens = [], [], 0
+    for turn, n_tokens in zip(turns, token_counts):
+        if current and current_tokens + n_tokens > max_tokens:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(turn)
+        current_tokens += n_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+class ReportBuilder:
+    def __init__(self, generate, tokenizer, chunk_tokens=None, summary_max_tokens=None):
+        self.generate = generate
+        self.tokenizer = tokenizer
+        self.prompt_tokens = len(tokenizer.encode(REPORT_PROMPT + PARTIAL_REPORT_HEADER, add_special_tokens=False))
+        self.chunk_tokens = chunk_tokens or int(os.getenv("REPORT_CHUNK_TOKENS", DEFAULT_REPORT_CHUNK_TOKENS))
+        self.summary_max_tokens = summary_max_tokens or int(os.getenv("REPORT_SUMMARY_MAX_TOKENS", DEFAULT_REPORT_SUMMARY_MAX_TOKENS))
+
+    async def build_prompt(self, conv, request_id):
+        turns = split_turns(conv)
+        token_ids = self.tokenizer.encode_batch(turns) if turns else []
+        token_counts = [len(ids) for ids in token_ids]
+        if sum(token_counts) <= self.chunk_tokens:
+            return REPORT_PROMPT + conv + "End of conversation"
+
+        turns, token_counts = split_long_turns(turns, token_ids, self.chunk_tokens, self.tokenizer.decode)
+        chunks = chunk_turns(turns, token_counts, self.chunk_tokens)
+        logging.info("Report %s: conversation of %s tokens split into %s chunks", request_id, sum(token_counts), len(chunks))
+        tasks = [
+            asyncio.ensure_future(self.summarize(chunk, part, len(chunks), f"{request_id}-part{part}"))
+            for part, chunk in enumerate(chunks, start=1)
+        ]
+        try:
+            summaries = await asyncio.gather(*tasks)
+        finally:
+            # A failed or cancelled summary cancels the others, which closes their generators and aborts their engine requests.
+            for task in tasks:
+                task.cancel()
+        partial_reports = "\n".join(f"Part {part}: {summary.strip()}" for part, summary in enumerate(summaries, start=1))
+        return REPORT_PROMPT + PARTIAL_REPORT_HEADER + partial_reports + "\nEnd of conversation"
+
+    async def summarize(self, chunk, part, parts, request_id):
+        prompt = SUMMARY_PROMPT.format(part=part, parts=parts) + chunk + "\nEnd of part"
+        sampling_params = SamplingParams(temperature=0, max_tokens=self.summary_max_tokens)
+        final_output = None
+        async for request_output in self.generate(prompt, sampling_params, request_id):
+            final_output = request_output
+        return final_output.outputs[0].text if final_output is not None else ""
@@ -0,0 +1,63 @@
+from admission import estimate_tokens
+from metrics import metrics
+
+
+def get_scheduler_state(llm):
+    scheduler = llm.engine.scheduler
+    return {"waiting": len(scheduler.waiting), "swapped": len(scheduler.swapped), "running": len(scheduler.running)}
+
+
+# Spreads requests over independent engine replicas, sending each one to the replica with the least outstanding work.
+class EngineRouter:
+    def __init__(self, replicas):
+        if not replicas:
+            raise ValueError("EngineRouter needs at least one engine replica")
+        self.replicas = list(replicas)
+        self.outstanding_tokens = [0] * len(self.replicas)
+        self.outstanding_sequences = [0] * len(self.replicas)
+        self.owners = {}
+
+    @property
+    def engine(self):
+        # Replicas serve the same model, so its config is read from the first one.
+        return self.replicas[0].engine
+
+    async def get_model_config(self):
+        return await self.replicas[0].get_model_config()
+
+    def pick(self):
+        # Tokens the router has dispatched are counted before the replica's scheduler sees them, so bursts still spread.
+        return min(range(len(self.replicas)), key=lambda index: (self.outstanding_tokens[index], self.outstanding_sequences[index]))
+
+    async def generate(self, prompt, sampling_params, request_id, prompt_token_ids=None):
+        index = self.pick()
+        prompt_tokens = len(prompt_token_ids) if prompt_token_ids is not None else estimate_tokens(prompt, 0)
+        charged = prompt_tokens + (sampling_params.max_tokens or 0) * max(sampling_params.n, sampling_params.best_of or 1)
+        self.outstanding_tokens[index] += charged
+        self.outstanding_sequences[index] += 1
+        self.owners[request_id] = index
+        metrics.inc(f"router_replica{index}_requests")
+        self._publish(index)
+        try:
+            credit = prompt_tokens
+            async for request_output in self.replicas[index].generate(prompt, sampling_params, request_id, prompt_token_ids=prompt_token_ids):
+                # After the first step the prompt is in the KV cache, only the undecoded tokens are left.
+                credit = min(credit + len(request_output.outputs), charged)
+                self.outstanding_tokens[index] -= credit
+                charged -= credit
+                credit = 0
+                yield request_output
+        finally:
+            self.outstanding_tokens[index] -= charged
+            self.outstanding_sequences[index] -= 1
+            self.owners.pop(request_id, None)
+            self._publish(index)
+
+    async def abort(self, request_id):
+        index = self.owners.get(request_id)
+        if index is not None:
+            await self.replicas[index].abort(request_id)
+
+    def _publish(self, index):
+        metrics.set(f"router_replica{index}_outstanding_tokens", self.outstanding_tokens[index])
+        metrics.set(f"router_replica{index}_outstanding_sequences", self.outstanding_sequences[index])
@@ -0,0 +1,29 @@
+import numpy as np
+from constants import NUM_INTENT_LABELS
+
+PENALTY_LABEL = NUM_INTENT_LABELS - 1
+PENALTY_THRESHOLD = 0.5
+INTENT_THRESHOLD = 4
+NEW_INTENT_POINTS = 10
+REPEATED_INTENT_POINTS = 1
+
+
+def score_turns(logits, score, count_usage):
+    logits = np.atleast_2d(np.asarray(logits, dtype=np.float32))
+    initial_usage = np.asarray(count_usage, dtype=np.int64)
+
+    penalty = logits[:, PENALTY_LABEL] > PENALTY_THRESHOLD
+    selected = (logits > INTENT_THRESHOLD) & ~penalty[:, None]
+    selected[:, PENALTY_LABEL] = False
+    first_use = selected & (np.cumsum(selected, axis=0) == 1) & (initial_usage == 0)
+    gains = NEW_INTENT_POINTS * first_use.sum(axis=1) + REPEATED_INTENT_POINTS * (selected & ~first_use).sum(axis=1)
+
+    # The score only clamps at zero on penalty turns, so it is the running total reflected
+    # by the lowest total reached on any penalty turn so far.
+    totals = score + np.cumsum(np.where(penalty, -1, gains))
+    floor = np.minimum.accumulate(np.where(penalty, totals, np.iinfo(np.int64).max))
+    trajectory = totals - np.minimum(floor, 0)
+
+    final_usage = np.where((initial_usage == 0) & selected.any(axis=0), 1, initial_usage)
+    final_usage[PENALTY_LABEL] += int(penalty.sum())
+    return trajectory.tolist(), final_usage.tolist()
@@ -0,0 +1,32 @@
+import base64
+
+
+def orjson_serializer():
+    try:
+        import orjson
+    except ImportError as e:
+        raise ImportError("serializer=orjson requires orjson, install it with `pip install orjson`") from e
+    return lambda batch: orjson.dumps(batch).decode()
+
+
+def msgpack_serializer():
+    try:
+        import msgpack
+    except ImportError as e:
+        raise ImportError("serializer=msgpack requires msgpack, install it with `pip install msgpack`") from e
+    # Stream outputs travel as JSON, so the binary payload is base64 encoded.
+    return lambda batch: base64.b64encode(msgpack.packb(batch)).decode()
+
+
+SERIALIZERS = {
+    "orjson": orjson_serializer,
+    "msgpack": msgpack_serializer,
+}
+
+
+def get_serializer(name):
+    if not name:
+        return None
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unknown serializer '{name}', must be one of {list(SERIALIZERS)}")
+    return SERIALIZERS[name]()
@@ -0,0 +1,86 @@
+import os
+import time
+from array import array
+from collections import OrderedDict
+from constants import DEFAULT_SESSION_STORE_MAX_SESSIONS, DEFAULT_SESSION_TTL_SECONDS, DEFAULT_SESSION_STORE_MAX_BYTES, NUM_INTENT_LABELS
+from metrics import metrics
+
+
+class Session:
+    __slots__ = ("session_id", "character", "history_ids", "turn_lengths", "score", "count_usage", "last_access")
+
+    def __init__(self, session_id, character=None, score=0, count_usage=None):
+        self.session_id = session_id
+        self.character = character
+        self.history_ids = array("i")
+        self.turn_lengths = array("i")
+        self.score = score
+        self.count_usage = count_usage if count_usage is not None else [0] * NUM_INTENT_LABELS
+        self.last_access = time.monotonic()
+
+    @property
+    def nbytes(self):
+        return self.history_ids.itemsize * (len(self.history_ids) + len(self.turn_lengths))
+
+
+class SessionStore:
+    def __init__(self, max_sessions=None, ttl=None, max_bytes=None):
+        self.max_sessions = max_sessions or int(os.getenv("SESSION_STORE_MAX_SESSIONS", DEFAULT_SESSION_STORE_MAX_SESSIONS))
+        self.ttl = ttl or float(os.getenv("SESSION_TTL_SECONDS", DEFAULT_SESSION_TTL_SECONDS))
+        self.max_bytes = max_bytes or int(os.getenv("SESSION_STORE_MAX_BYTES", DEFAULT_SESSION_STORE_MAX_BYTES))
+        self.sessions = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, session_id):
+        session = self.peek(session_id)
+        if session is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        session.last_access = time.monotonic()
+        self.sessions.move_to_end(session_id)
+        return session
+
+    def peek(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is not None and time.monotonic() - session.last_access > self.ttl:
+            self._remove(session_id)
+            self._count("expirations")
+            return None
+        return session
+
+    def put(self, session):
+        if session.session_id in self.sessions:
+            self._remove(session.session_id)
+        session.last_access = time.monotonic()
+        self.sessions[session.session_id] = session
+        self.sizes[session.session_id] = session.nbytes
+        self.nbytes += session.nbytes
+        self._evict()
+        metrics.set("session_store_sessions", len(self.sessions))
+        metrics.set("session_store_bytes", self.nbytes)
+
+    def get_stats(self):
+        return dict(self.stats, sessions=len(self.sessions), bytes=self.nbytes)
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if now - session.last_access > self.ttl:
+                self._count("expirations")
+            elif len(self.sessions) > self.max_sessions or self.nbytes > self.max_bytes:
+                self._count("evictions")
+            else:
+                break
+            self._remove(session_id)
+
+    def _remove(self, session_id):
+        del self.sessions[session_id]
+        self.nbytes -= self.sizes.pop(session_id)
+
+    def _count(self, name):
+        self.stats[name] += 1
+        metrics.inc(f"session_store_{name}")
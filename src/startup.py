@@ -0,0 +1,49 @@
+import os
+import json
+import time
+import logging
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics, start_exporter
+
+
+class StartupReport:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.phases = {}
+
+    def timed(self, name, fn, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.phases[name] = round((time.monotonic() - start) * 1000, 1)
+
+    def finish(self):
+        report = {"total_ms": round((time.monotonic() - self.start) * 1000, 1), "phases": self.phases}
+        for name, ms in report["phases"].items():
+            metrics.set(f"startup_{name}_ms", ms)
+        metrics.set("startup_total_ms", report["total_ms"])
+        logging.info("Startup report: %s", json.dumps(report))
+        return report
+
+
+def load_worker(engine=None, tokenizer=None, classifier=None):
+    report = StartupReport()
+    engine_module = report.timed("import_engine", importlib.import_module, "engine")
+    classifier_module = report.timed("import_classifier", importlib.import_module, "classifier")
+
+    # The engine (LLM weights and HF tokenizer) and the intent classifier are independent, so they load side by side.
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="startup") as pool:
+        classifier = classifier_module.BatchedClassifier(classifier)
+        classifier_future = pool.submit(report.timed, "classifier", classifier.warmup)
+        vllm_engine = report.timed("engine", engine_module.vLLMEngine, engine, tokenizer)
+        classifier_future.result()
+    for name, seconds in vllm_engine.load_times.items():
+        report.phases[f"engine_{name}"] = round(seconds * 1000, 1)
+
+    if engine is None and bool(int(os.getenv("ENGINE_WARMUP", 1))):
+        report.timed("engine_warmup", vllm_engine.warmup)
+    report.finish()
+    start_exporter()
+    return vllm_engine, classifier
@@ -0,0 +1,333 @@
+import time
+import logging
+from array import array
+from constants import DEFAULT_MAX_ADAPTIVE_BATCH_SIZE, DEFAULT_ADAPTIVE_BATCH_GROWTH
+from logprobs import LogprobColumns
+
+
+class FlushPolicy:
+    def __init__(self, batch_size, first_token=False, max_latency_ms=None, max_bytes=None, adaptive=False,
+                 max_batch_size=DEFAULT_MAX_ADAPTIVE_BATCH_SIZE, growth=DEFAULT_ADAPTIVE_BATCH_GROWTH):
+        self.batch_size = batch_size
+        self.first_token = first_token
+        self.max_latency = max_latency_ms / 1000 if max_latency_ms else None
+        self.max_bytes = max_bytes
+        self.adaptive = adaptive
+        self.max_batch_size = max(max_batch_size, batch_size)
+        self.growth = growth
+        self.has_triggers = bool(first_token or self.max_latency or max_bytes)
+
+    @classmethod
+    def from_config(cls, batch_size, config):
+        if not config:
+            return cls(batch_size)
+        known = {"first_token", "max_latency_ms", "max_bytes", "adaptive", "max_batch_size", "growth"}
+        invalid = [key for key in config if key not in known]
+        if invalid:
+            logging.warning("Ignoring invalid flush policy params: %s", invalid)
+        return cls(batch_size, first_token=config.get("first_token", True),
+                   **{key: value for key, value in config.items() if key in known and key != "first_token"})
+
+    def should_flush(self, n_tokens, n_bytes, n_flushes, since_last_flush):
+        if n_tokens >= self.batch_size:
+            return True
+        if not self.has_triggers:
+            return False
+        if self.first_token and n_flushes == 0:
+            return True
+        if self.max_bytes is not None and n_bytes >= self.max_bytes:
+            return True
+        return self.max_latency is not None and since_last_flush() >= self.max_latency
+
+    def on_flush(self):
+        if self.adaptive:
+            self.batch_size = min(int(self.batch_size * self.growth) or 1, self.max_batch_size)
+
+
+class StopMarkers:
+    # Speaker markers that end a role-play turn, e.g. the model going on to write the user's next line.
+    def __init__(self, markers):
+        self.markers = tuple(marker for marker in markers if marker)
+        self.max_len = max(map(len, self.markers), default=0)
+        # Whitespace-only prefixes like "\n" end too much ordinary text to hold a flush for, at worst that whitespace is sent before a cut.
+        self.prefixes = {marker[:k] for marker in self.markers for k in range(1, len(marker)) if marker[:k].strip()}
+
+    def find(self, text, start):
+        # Earliest marker ending past start, a marker can span several tokens.
+        found = -1
+        for marker in self.markers:
+            position = text.find(marker, max(start - len(marker) + 1, 0))
+            if position != -1 and (found == -1 or position < found):
+                found = position
+        return found
+
+    def is_partial(self, text):
+        return any(text[-k:] in self.prefixes for k in range(1, min(self.max_len, len(text) + 1)))
+
+
+class StreamAggregator:
+    def __init__(self, n_responses, stream, batch_size, flush_policy=None):
+        self.n_responses = n_responses
+        self.stream = stream
+        self.flush_policy = flush_policy or FlushPolicy(batch_size)
+        self.offsets = [0] * n_responses
+        self.texts = [""] * n_responses
+        self.n_input_tokens = 0
+        self.n_output_tokens = 0
+        self.n_batch_tokens = 0
+        self.n_batch_bytes = 0
+        self.last_request_output = None
+        self._tokens = [[] for _ in range(n_responses)]
+        self.start_time = self.last_flush_time = time.monotonic()
+        self.n_flushes = 0
+        self.first_output_latency = None
+        self.ttft = None
+        self.batch_gaps = []
+        self.extra_usage = {}
+        self.stop_markers = None
+        self.stopped_choices = [False] * n_responses
+        self.stopped = False
+        self.logprobs = None
+        self.prompt_top_k = None
+        self._prompt_logprobs = None
+
+    def track_logprobs(self, top_k, prompt_top_k, capacity=None):
+        if top_k is not None:
+            self.logprobs = [LogprobColumns(top_k, capacity) for _ in range(self.n_responses)]
+        self.prompt_top_k = prompt_top_k
+
+    def add(self, request_output):
+        if self.last_request_output is None:  # Count input tokens only once
+            self.n_input_tokens = len(request_output.prompt_token_ids)
+            self.first_output_latency = time.monotonic() - self.start_time
+            if self.prompt_top_k is not None:
+                self._add_prompt_logprobs(request_output)
+        self.last_request_output = request_output
+
+        offsets, texts, stop_markers = self.offsets, self.texts, self.stop_markers
+        for output in request_output.outputs:
+            index, text = output.index, output.text
+            if stop_markers is not None:
+                if self.stopped_choices[index]:
+                    continue
+                stop = stop_markers.find(text, offsets[index])
+            self.n_output_tokens += 1
+            if self.stream:
+                delta = text[offsets[index]:]
+                self._tokens[index].append(delta)
+                self.n_batch_tokens += 1
+                self.n_batch_bytes += len(delta)
+            offsets[index] = len(text)
+            texts[index] = text
+            if stop_markers is not None and stop != -1:
+                self._stop(index, stop)
+        if self.logprobs is not None:
+            self._add_logprobs(request_output)
+
+        # The last output is always left to finish(), so the final batch carries usage and latency stats.
+        if self.stream and not self.stopped and not request_output.finished:
+            policy = self.flush_policy
+            if self.n_batch_tokens >= policy.batch_size or (policy.has_triggers and policy.should_flush(self.n_batch_tokens, self.n_batch_bytes, self.n_flushes, self._since_last_flush)):
+                if stop_markers is None or not self._holds_partial_marker():
+                    return self._flush()
+        return None
+
+    def finish(self):
+        if not self.stream:
+            self._tokens = [[text] for text in self.texts]
+            self.n_batch_tokens += 1
+        if self.n_batch_tokens > 0 or self.last_request_output is not None:
+            return self._flush(final=True)
+        return None
+
+    def usage(self):
+        usage = {"input": self.n_input_tokens, "output": self.n_output_tokens}
+        if self.extra_usage:
+            usage.update(self.extra_usage)
+        return usage
+
+    def latency_stats(self):
+        gaps = self.batch_gaps
+        return {
+            "ttft_ms": round(self.ttft * 1000, 2) if self.ttft is not None else None,
+            "batches": self.n_flushes,
+            "mean_batch_gap_ms": round(sum(gaps) / len(gaps) * 1000, 2) if gaps else None,
+            "max_batch_gap_ms": round(max(gaps) * 1000, 2) if gaps else None,
+        }
+
+    def _add_logprobs(self, request_output):
+        for output in request_output.outputs:
+            if output.logprobs is not None and not self.stopped_choices[output.index]:
+                self.logprobs[output.index].extend(output.token_ids, output.logprobs)
+
+    def _add_prompt_logprobs(self, request_output):
+        prompt_logprobs = getattr(request_output, "prompt_logprobs", None)
+        if prompt_logprobs:
+            # The first prompt token has no logprob, so the columns start at the second one.
+            columns = LogprobColumns(self.prompt_top_k, len(prompt_logprobs))
+            columns.extend(request_output.prompt_token_ids, prompt_logprobs)
+            self._prompt_logprobs = columns.flush()
+
+    def _attach_logprobs(self, batch):
+        if self.logprobs is not None:
+            for choice, columns in zip(batch["choices"], self.logprobs):
+                choice["logprobs"] = columns.flush()
+        if self._prompt_logprobs is not None:
+            batch["prompt_logprobs"], self._prompt_logprobs = self._prompt_logprobs, None
+        return batch
+
+    def _stop(self, index, end):
+        # Cuts the choice right before the marker, choices stop independently and the request once all have.
+        self._truncate(index, end)
+        self.texts[index] = self.texts[index][:end]
+        self.offsets[index] = end
+        self.stopped_choices[index] = True
+        self.stopped = all(self.stopped_choices)
+
+    def _truncate(self, index, end):
+        tokens, excess = self._tokens[index], len(self.texts[index]) - end
+        while tokens and excess > 0:
+            token = tokens.pop()
+            if len(token) > excess:
+                tokens.append(token[:-excess])
+            excess -= len(token)
+
+    def _holds_partial_marker(self):
+        # Flushing while a choice ends with the start of a marker could send text that is about to be cut.
+        return any(not stopped and self.stop_markers.is_partial(text) for stopped, text in zip(self.stopped_choices, self.texts))
+
+    def _since_last_flush(self):
+        return time.monotonic() - self.last_flush_time
+
+    def _flush(self, final=False):
+        now = time.monotonic()
+        if self.ttft is None:
+            self.ttft = now - self.start_time
+        else:
+            self.batch_gaps.append(now - self.last_flush_time)
+        self.last_flush_time = now
+        self.n_flushes += 1
+        self.flush_policy.on_flush()
+
+        batch = self._build_batch(final)
+        self._reset_batch()
+        self.n_batch_tokens = 0
+        self.n_batch_bytes = 0
+        return batch
+
+    def _reset_batch(self):
+        self._tokens = [[] for _ in range(self.n_responses)]
+
+    def _build_batch(self, final):
+        usage = self.usage()
+        if final and self.stream:
+            usage.update(self.latency_stats())
+        return self._attach_logprobs({
+            "choices": [{"tokens": tokens} for tokens in self._tokens],
+            "usage": usage,
+        })
+
+
+class CompactStreamAggregator(StreamAggregator):
+    # Sends one delta string per choice with the end offset of every token in it, instead of a list of token strings.
+    def __init__(self, n_responses, stream, batch_size, flush_policy=None):
+        super().__init__(n_responses, stream, batch_size, flush_policy)
+        self._reset_batch()
+
+    def add(self, request_output):
+        if self.last_request_output is None:  # Count input tokens only once
+            self.n_input_tokens = len(request_output.prompt_token_ids)
+            self.first_output_latency = time.monotonic() - self.start_time
+            if self.prompt_top_k is not None:
+                self._add_prompt_logprobs(request_output)
+        self.last_request_output = request_output
+
+        offsets, texts, stop_markers = self.offsets, self.texts, self.stop_markers
+        for output in request_output.outputs:
+            index, text = output.index, output.text
+            if stop_markers is not None:
+                if self.stopped_choices[index]:
+                    continue
+                stop = stop_markers.find(text, offsets[index])
+            self.n_output_tokens += 1
+            if self.stream:
+                self._ends[index].append(len(text) - self._starts[index])
+                self.n_batch_tokens += 1
+                self.n_batch_bytes += len(text) - offsets[index]
+            offsets[index] = len(text)
+            texts[index] = text
+            if stop_markers is not None and stop != -1:
+                self._stop(index, stop)
+        if self.logprobs is not None:
+            self._add_logprobs(request_output)
+
+        if self.stream and not self.stopped and not request_output.finished:
+            policy = self.flush_policy
+            if self.n_batch_tokens >= policy.batch_size or (policy.has_triggers and policy.should_flush(self.n_batch_tokens, self.n_batch_bytes, self.n_flushes, self._since_last_flush)):
+                if stop_markers is None or not self._holds_partial_marker():
+                    return self._flush()
+        return None
+
+    def finish(self):
+        if not self.stream:
+            self._ends = [array("i", [len(text)]) for text in self.texts]
+            self.n_batch_tokens += 1
+        # usage is only in the final batch, so it is sent even when the last output was already flushed.
+        if self.n_batch_tokens > 0 or self.last_request_output is not None:
+            return self._flush(final=True)
+        return None
+
+    def _truncate(self, index, end):
+        ends, end = self._ends[index], end - self._starts[index]
+        while ends and ends[-1] > end:
+            ends.pop()
+        if end > (ends[-1] if ends else 0):
+            ends.append(end)
+
+    def _reset_batch(self):
+        self._starts = list(self.offsets)
+        self._ends = [array("i") for _ in range(self.n_responses)]
+
+    def _build_batch(self, final):
+        batch = {
+            "choices": [
+                {"text": self.texts[index][start:self.offsets[index]], "offsets": ends.tolist()}
+                for index, (start, ends) in enumerate(zip(self._starts, self._ends))
+            ],
+        }
+        if final:
+            batch["usage"] = self.usage()
+            if self.stream:
+                batch["usage"].update(self.latency_stats())
+        return self._attach_logprobs(batch)
+
+
+class OpenAIStreamAggregator(StreamAggregator):
+    def __init__(self, n_responses, batch_size, request_id, model, flush_policy=None):
+        super().__init__(n_responses, True, batch_size, flush_policy)
+        self.id = f"cmpl-{request_id}"
+        self.created = int(time.time())
+        self.model = model
+
+    def _build_batch(self, final):
+        finish_reasons = {output.index: output.finish_reason for output in self.last_request_output.outputs}
+        batch = {
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [
+                {"index": index, "delta": {"content": tokens}, "finish_reason": finish_reasons.get(index)}
+                # The final chunk lists every choice, so each one's finish_reason is sent even without new tokens.
+                for index, tokens in enumerate(self._tokens) if tokens or final
+            ],
+        }
+        if final:
+            batch["usage"] = {
+                "prompt_tokens": self.n_input_tokens,
+                "completion_tokens": self.n_output_tokens,
+                "total_tokens": self.n_input_tokens + self.n_output_tokens,
+                **self.latency_stats(),
+                **self.extra_usage,
+            }
+        return batch
@@ -0,0 +1,57 @@
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from metrics import metrics
+
+TRACING_ENABLED = bool(int(os.getenv("ENABLE_TRACING", 0)))
+
+
+class Trace:
+    enabled = True
+
+    def __init__(self, return_timings=False):
+        self.start = time.monotonic()
+        self.return_timings = return_timings
+        self.spans = []
+
+    @contextmanager
+    def span(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.monotonic() - start)
+
+    def record(self, name, start, duration):
+        self.spans.append((name, start - self.start, duration))
+        metrics.observe(f"span_{name}_ms", duration * 1000)
+
+    def timings(self):
+        return {
+            "total_ms": round((time.monotonic() - self.start) * 1000, 2),
+            "spans": [
+                {"name": name, "start_ms": round(start * 1000, 2), "duration_ms": round(duration * 1000, 2)}
+                for name, start, duration in self.spans
+            ],
+        }
+
+
+class NullTrace:
+    enabled = False
+    return_timings = False
+    _span = nullcontext()
+
+    def span(self, name):
+        return self._span
+
+    def record(self, name, start, duration):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+def start_trace(return_timings=False):
+    if TRACING_ENABLED or return_timings:
+        return Trace(return_timings)
+    return NULL_TRACE
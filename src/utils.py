@@ -1,7 +1,10 @@
+import os
+import json
+import time
 import logging
 from typing import Any, Dict
 from vllm.utils import random_uuid
-from constants import SAMPLING_PARAM_TYPES, DEFAULT_BATCH_SIZE
+from constants import SAMPLING_PARAM_TYPES, DEFAULT_BATCH_SIZE, LOCAL_MODELS_MANIFEST
 
 logging.basicConfig(level=logging.INFO)
 
@@ -22,6 +25,14 @@ def count_physical_cores():
 
     return len(cores)
 
+def get_local_model_path(role, name):
+    if name and os.path.exists(LOCAL_MODELS_MANIFEST):
+        with open(LOCAL_MODELS_MANIFEST) as f:
+            entry = json.load(f).get(role)
+        if entry and entry["name"] == name:
+            return entry["path"]
+    return name
+
 def validate_sampling_params(params: Dict[str, Any]) -> Dict[str, Any]:
     validated_params = {}
     invalid_params = []
@@ -38,23 +49,34 @@ def validate_sampling_params(params: Dict[str, Any]) -> Dict[str, Any]:
     return validated_params
 
 class JobInput:
-    def __init__(self, job):
+    def __init__(self, job, request_id=None):
         self.stream = job.get("stream", False)
         self.batch_size = job.get("batch_size", DEFAULT_BATCH_SIZE)
+        self.flush_policy = job.get("flush_policy")
         self.apply_chat_template = job.get("apply_chat_template", False)
         self.use_openai_format = job.get("use_openai_format", False)
         self.validated_sampling_params = validate_sampling_params(job.get("sampling_params", {}))
         self.task=job.get("task", "chat")
-        if self.task=="chat":
+        self.timeout = job.get("timeout")
+        self.output_format = job.get("output_format", "default")
+        if self.output_format not in ("default", "compact"):
+            raise ValueError(f"Unknown output_format '{self.output_format}', must be 'default' or 'compact'")
+        if self.use_openai_format:
+            self.llm_input = job.get("messages", job.get("prompt"))
+        elif self.task=="chat":
             self.score=job.get("score", 0)
             self.character=job.get("character","anabal")
             self.difficulty = job.get("difficulty", "easy")
             self.llm_input = job.get("messages", job.get("prompt"))
             self.count_usage = job.get("count_usage",[0,0,0,0,0,0,0,0,0,0,0,0,0,0,0])
+            self.session_id = job.get("session_id")
         elif self.task=="report":
             self.conv=job.get("conv", "")
-        self.request_id = random_uuid()
+        self.request_id = request_id or random_uuid()
            
 class DummyRequest:
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+
     async def is_disconnected(self):
-        return False
+        return self.deadline is not None and time.monotonic() > self.deadline